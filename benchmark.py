@@ -0,0 +1,197 @@
+"""
+Reproducible benchmark of the fitness evaluation: fixed seeds and stored genomes, the
+results are written to RESULT_FILE (JSON) and compared with a saved baseline.
+
+    uv run benchmark.py [BACKEND ...] [--save-baseline]
+
+BACKEND is "panda", "raster" or "incremental" (default: all), --save-baseline stores
+the results as BASELINE_FILE. Returns with exit code 1 if a metric regressed by more
+than TOLERANCE against the baseline or a fitness value changed.
+"""
+import json
+import os
+import platform
+import random
+import sys
+from time import perf_counter, time
+import numpy as np
+import genetics
+import telemetry
+import visualization
+from telemetry import timers
+
+
+SEED = 1234
+# stored genomes, plus RANDOM_GENOMES generated ones (220 genes each)
+GENOME_FILES = ["numbers.json", "just_one.json", "random.json"]
+RANDOM_GENOMES = 20
+# throughput is the best of REPEATS passes over all genomes
+REPEATS = 3
+# small GA for the generation time (generation 0 evaluates everything and is not counted)
+GENERATION_SIZE = 40
+GENERATIONS = 4
+
+RESULT_FILE = "tmp/benchmark.json"
+BASELINE_FILE = "benchmark_baseline.json"
+# relative change of a metric that counts as regression
+TOLERANCE = 0.10
+# metrics below this value (e.g. 0.01 ms) are too small to be compared reliably
+NOISE_FLOOR = 0.01
+# metrics where higher is better, lower is better for all others
+HIGHER_IS_BETTER = {"individuals_per_second"}
+
+
+def load_genomes():
+    """
+    return the genomes to benchmark as {name: genom}, the random ones are the same for every run
+    """
+    genomes = {}
+    for file in GENOME_FILES:
+        with open(file, "r") as f:
+            genomes[file] = [tuple(gene) for gene in json.load(f)]
+    random.seed(SEED)
+    for i in range(RANDOM_GENOMES):
+        genomes[f"random_{i}"] = genetics.Individual.random_individual(220).genom
+    return genomes
+
+
+def benchmark_backend(app, backend, genomes):
+    """
+    return the metrics of the backend: fitness throughput, latency of set_configuration(),
+    of rendering a view (with readback) and of a generation, and the fitness of each genome
+    """
+    genetics.FITNESS_BACKEND = backend
+    # rendering is measured, not the footprint cache (the same genomes are evaluated repeatedly)
+    genetics.FOOTPRINT_CACHE_MB = 0
+    target_images = [f"{genetics.FITNESS_IMAGE_PATH}{image}" for image in genetics.FITNESS_IMAGES.split(",")]
+    fitness = genetics.Genetics(target_images).create_fitness(app)
+    values = {name: fitness.fitness_function(genom) for name, genom in genomes.items()}  # warm up
+
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = perf_counter()
+        for genom in genomes.values():
+            fitness.fitness_function(genom)
+        best = min(best, perf_counter() - start)
+
+    set_configuration = 0.0
+    render_view = 0.0
+    timers.enabled = True
+    timers.reset()
+    for genom in genomes.values():
+        start = perf_counter()
+        fitness.set_configuration(genom)
+        set_configuration += perf_counter() - start
+        start = perf_counter()
+        for i in range(fitness.view_count):
+            fitness.render_view(i)
+        render_view += perf_counter() - start
+    stages = timers.reset()
+    timers.enabled = False
+
+    metrics = {
+        "individuals_per_second": len(genomes) / best,
+        "set_configuration_ms": set_configuration / len(genomes) * 1000,
+        "render_view_ms": render_view / len(genomes) / fitness.view_count * 1000,
+    }
+    # per call latency of the stages of a view (e.g. render_frame and readback)
+    for stage, timing in stages.items():
+        metrics[f"{stage}_ms"] = timing["seconds"] / timing["calls"] * 1000
+    metrics["generation_seconds"] = benchmark_generations(app, target_images)
+    return {"metrics": metrics, "fitness": values}
+
+
+def benchmark_generations(app, target_images):
+    """
+    return the average duration of a generation of a small GA with a fixed seed
+    """
+    path = "tmp/benchmark_telemetry.jsonl"
+    if os.path.exists(path):
+        os.remove(path)
+    genetics.SIZE_OF_GENERATION = GENERATION_SIZE
+    genetics.SIZE_OF_GENOM = 220
+    genetics.SURVIVOR_RATE = 0.5
+    genetics.TOURNAMENT_SIZE = GENERATIONS
+    genetics.TELEMETRY = path
+    random.seed(SEED)
+    genetics.Population.rng = np.random.default_rng(SEED)
+    genetics.Genetics(target_images).run(app)
+    timers.enabled = False
+    genetics.TELEMETRY = ""
+    with open(path, "r") as f:
+        durations = [json.loads(line)["duration"] for line in f][1:]
+    return sum(durations) / len(durations)
+
+
+def compare(results, baseline):
+    """
+    print the metrics next to the baseline, return the regressions (descriptions)
+    """
+    regressions = []
+    print(f"{'backend':12s} {'metric':28s} {'baseline':>12s} {'current':>12s} {'change':>8s}")
+    for backend, result in results["backends"].items():
+        if backend not in baseline["backends"]:
+            continue
+        expected = baseline["backends"][backend]
+        for metric, value in result["metrics"].items():
+            if metric not in expected["metrics"]:
+                continue
+            reference = expected["metrics"][metric]
+            change = (value - reference) / reference if reference else 0.0
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = ""
+            if worse > TOLERANCE and max(value, reference) >= NOISE_FLOOR:
+                flag = "  REGRESSION"
+                regressions.append(f"{backend} {metric}: {reference:.4f} -> {value:.4f}")
+            print(f"{backend:12s} {metric:28s} {reference:12.4f} {value:12.4f} {change * 100:7.1f}%{flag}")
+        for name, value in result["fitness"].items():
+            if name in expected["fitness"] and abs(value - expected["fitness"][name]) > 1e-6:
+                regressions.append(f"{backend} fitness of {name}: {expected['fitness'][name]:.6f} -> {value:.6f}")
+    return regressions
+
+
+def run(app, backends, save_baseline):
+    genomes = load_genomes()
+    results = {
+        "time": time(),
+        "seed": SEED,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "genomes": len(genomes),
+        "backends": {},
+    }
+    for backend in backends:
+        print(f"Info: Benchmarking backend '{backend}'...")
+        results["backends"][backend] = benchmark_backend(app, backend, genomes)
+    results["max_rss_mb"] = telemetry.max_rss_mb()
+    os.makedirs(os.path.dirname(RESULT_FILE), exist_ok=True)
+    with open(RESULT_FILE, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Info: Results saved to {RESULT_FILE}")
+    regressions = []
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, "r") as f:
+            regressions = compare(results, json.load(f))
+        for regression in regressions:
+            print(f"Warn: Regression {regression}")
+    if save_baseline:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Info: Baseline saved to {BASELINE_FILE}")
+    return regressions
+
+
+if __name__ == "__main__":
+    save_baseline = "--save-baseline" in sys.argv
+    backends = [arg for arg in sys.argv[1:] if not arg.startswith("--")] or ["panda", "raster", "incremental"]
+    for backend in backends:
+        assert backend in ("panda", "raster", "incremental"), f"Error: Unknown backend '{backend}'."
+    regressions = []
+    if "panda" in backends:
+        visualization.headless_app(callback=lambda app: regressions.extend(run(app, backends, save_baseline)),
+                                   prc_file="headless_128x128.prc")
+    else:
+        regressions = run(None, backends, save_baseline)
+    sys.exit(1 if regressions else 0)
@@ -1,9 +1,50 @@
 from logging import DEBUG
-from panda3d.core import PNMImage
+from collections import OrderedDict, deque
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+from math import radians, tan
+from time import perf_counter
+import numpy as np
+from panda3d.core import PNMImage, Texture
+from visualization import SIZE_SCALE
+from telemetry import timers
 
 
 DEBUG = False
 
+# weights used by PNMImage.getGray() for color images (see PNMImage::get_bright)
+# in the order of the components of a texture's RAM image (BGR)
+LUMINANCE_BGR = np.array([0.114, 0.587, 0.299], dtype=np.float32)
+
+
+def texture_to_ink(texture, out=None):
+    """
+    return the amount of "ink" (1 - gray level) of each pixel of the texture as
+    a flat float32 array, rows are in the order of the RAM image (bottom up)
+    """
+    assert texture.getComponentWidth() == 1, "Only 8 bit textures are supported"
+    ram = np.frombuffer(texture.getRamImage(), dtype=np.uint8).reshape(-1, texture.getNumComponents())
+    return ram_to_ink(ram, out)
+
+
+def ram_to_ink(ram, out=None):
+    """
+    return the ink of each pixel of a RAM image given as uint8 array of shape (pixels, components)
+    """
+    components = ram.shape[1]
+    if out is None:
+        out = np.empty(ram.shape[0], dtype=np.float32)
+    if components >= 3:
+        np.dot(ram[:, :3], LUMINANCE_BGR / 255.0, out=out)
+    else:
+        np.multiply(ram[:, 0], 1.0 / 255.0, out=out, casting="unsafe")
+    np.subtract(1.0, out, out=out)
+    return out
+
 
 class MaskImage():
 
@@ -61,36 +102,727 @@ class MaskImage():
         return tmp_image
 
 
+    def get_ink(self):
+        """
+        return the ink (1 - gray level) of the mask as flat float32 array,
+        rows are in the order of a texture's RAM image (bottom up)
+        """
+        texture = Texture()
+        texture.load(self.image)
+        return texture_to_ink(texture)
+
+
+def pool_masks(masks, size, level):
+    """
+    return the masks (views, pixels) with blocks of 2^level x 2^level pixels summed up
+    """
+    width, height = size
+    factor = 2 ** level
+    assert width % factor == 0 and height % factor == 0, f"Image size must be divisible by {factor}"
+    pooled = masks.reshape(-1, height // factor, factor, width // factor, factor).sum(axis=(2, 4))
+    return pooled.reshape(masks.shape[0], -1)
+
+
+class MaskStore():
+    """
+    Precompiled target masks in one binary file: the ink of the masks and of the
+    inverted masks, their darkness and a pyramid of the target/background masks
+    (level l sums blocks of 2^l x 2^l pixels). The arrays are memory-mapped
+    read-only, so processes using the same store share them.
+    File layout: magic, header length (8 bytes), JSON header, 64 byte aligned arrays
+    (offsets in the header are relative to the first array).
+    """
+
+    MAGIC = b"GAMASKS1"
+    LEVELS = 3
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            assert f.read(len(MaskStore.MAGIC)) == MaskStore.MAGIC, f"Not a mask store: {path}"
+            header_size = int.from_bytes(f.read(8), "little")
+            self.header = json.loads(f.read(header_size))
+            start = f.tell() + (-f.tell() % 64)
+        self.size = tuple(self.header["size"])
+        self.arrays = {name: np.memmap(path, dtype=dtype, mode="r", offset=start + offset, shape=tuple(shape))
+                       for name, (dtype, offset, shape) in self.header["arrays"].items()}
+
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+
+    @staticmethod
+    def source_digests(mask_image_paths):
+        digests = []
+        for path in mask_image_paths:
+            with open(path, "rb") as f:
+                digests.append(hashlib.blake2b(f.read(), digest_size=16).hexdigest())
+        return digests
+
+
+    @staticmethod
+    def load(mask_image_paths, path):
+        """
+        return the store at path, (re)compile it if missing or outdated
+        """
+        if os.path.isfile(path):
+            store = MaskStore(path)
+            if store.header["sources"] == MaskStore.source_digests(mask_image_paths):
+                return store
+        MaskStore.compile(mask_image_paths, path)
+        return MaskStore(path)
+
+
+    @staticmethod
+    def compile(mask_image_paths, path):
+        mask_images = [MaskImage(image_path) for image_path in mask_image_paths]
+        inverted_mask_images = [image.invert_image() for image in mask_images]
+        size = (mask_images[0].image.getXSize(), mask_images[0].image.getYSize())
+        ink = np.stack([image.get_ink() for image in mask_images])
+        target = (ink > 0.1).astype(np.float32)
+        arrays = {
+            "ink": ink,
+            "inverted_ink": np.stack([image.get_ink() for image in inverted_mask_images]),
+            "darkness": np.array([image.darkness for image in mask_images]),
+            "inverted_darkness": np.array([image.darkness for image in inverted_mask_images]),
+        }
+        for level in range(MaskStore.LEVELS):
+            arrays[f"target_{level}"] = pool_masks(target, size, level)
+            arrays[f"background_{level}"] = pool_masks(1.0 - target, size, level)
+        table = {}
+        offset = 0
+        for name, array in arrays.items():
+            table[name] = [array.dtype.str, offset, list(array.shape)]
+            offset += -(-array.nbytes // 64) * 64
+        header = json.dumps({"size": size, "sources": MaskStore.source_digests(mask_image_paths),
+                             "arrays": table}).encode()
+        # write to a temporary file first, so that no process maps a partial store
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(MaskStore.MAGIC)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            for array in arrays.values():
+                f.write(b"\0" * (-f.tell() % 64))
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(tmp_path, path)
+
+
 class FitnessFunction():
 
-    def __init__(self, app, mask_image_paths, fitness_function_factor=1.0):
+    # whether coarse_fitness() already is the exact fitness (a cascade saves nothing)
+    exact_coarse_fitness = False
+
+    def __init__(self, app, mask_image_paths, fitness_function_factor=1.0, vectorized=True, tiled=False,
+                 mask_store=None):
         self.app = app
-        self.mask_images = [MaskImage(path) for path in mask_image_paths]
-        self.inverted_mask_images = [image.invert_image() for image in self.mask_images]
+        self.mask_store = mask_store
+        self.mask_image_paths = mask_image_paths
+        if mask_store is None:
+            self._load_mask_images()
+            self.image_size = (self.tmp_image.getXSize(), self.tmp_image.getYSize())
+        else:
+            assert vectorized, "A mask store requires vectorized scoring"
+            # the images are only needed for DEBUG output, loaded on demand
+            self.mask_images = None
+            self.image_size = mask_store.size
 
         self.fitness_function_factor = fitness_function_factor
+        self.vectorized = vectorized
+        self.tiled = tiled
+
+        self.view_count = len(mask_image_paths)
+        self.positions = [(i * (360.0 / self.view_count)) for i in range(self.view_count)]
+        # evaluations stopped early since the threshold could not be reached
+        self.partial = False
+        self.early_exits = 0
+        self.skipped_views = 0
+
+        self._prepare_masks()
+        if self.tiled:
+            assert self.vectorized, "Tiled rendering requires vectorized scoring"
+            self.tile_size = self.image_size
+            self.app.setup_tiled_views(self.positions, self.tile_size)
+            rows, columns = self.app.tile_layout
+            self.tile_ink = np.empty(rows * columns * self.ink.shape[1], dtype=np.float32)
 
+
+    def _load_mask_images(self):
+        self.mask_images = [MaskImage(path) for path in self.mask_image_paths]
+        self.inverted_mask_images = [image.invert_image() for image in self.mask_images]
         self.tmp_image = PNMImage()
         self.tmp_image.copyFrom(self.mask_images[0].image)
         self.tmp_image.setNumChannels(1)
 
-        count = len(self.mask_images)
-        self.positions = [(i * (360.0 / count)) for i in range(count)]
 
+    def _prepare_masks(self):
+        """
+        Precompute the masks as matrices, so that the scores of all views can be
+        computed with a few dot products (see score_views()).
+        A pixel is part of the target if its gray level is below 0.9 (see MaskImage).
+        """
+        if self.mask_store is not None:
+            mask_ink = self.mask_store["ink"]
+            self.target = self.mask_store["target_0"]
+            self.background = self.mask_store["background_0"]
+        else:
+            mask_ink = np.stack([image.get_ink() for image in self.mask_images])
+            self.target = (mask_ink > 0.1).astype(np.float32)
+            self.background = 1.0 - self.target
+        # match score: ink inside the target plus the ink of the mask outside of it,
+        # relative to the total ink of the mask
+        self.match_offset = (mask_ink * self.background).sum(axis=1)
+        self.match_total = mask_ink.sum(axis=1)
+        # mismatch score: average ink outside of the target
+        self.mismatch_total = self.background.sum(axis=1)
+        # highest possible score of each view (full ink on the target, none outside of it),
+        # above 1 for masks with ink outside of the target
+        self.max_scores = ((self.target.sum(axis=1) + self.match_offset) / self.match_total).astype(np.float64)
+        self.ink = np.empty(mask_ink.shape, dtype=np.float32)
+
+
+    def mask_level(self, name, level):
+        """
+        return the target or background masks with blocks of 2^level x 2^level pixels summed up
+        """
+        if self.mask_store is not None and level < MaskStore.LEVELS:
+            return self.mask_store[f"{name}_{level}"]
+        return pool_masks(getattr(self, name), self.image_size, level)
+
+
+    def score_views(self, ink, views=slice(None), target=None, background=None):
+        """
+        return the score of each view given the ink of the rendered views as
+        array of shape (views, pixels), views selects the masks if not all views are given
+        """
+        target = self.target if target is None else target
+        background = self.background if background is None else background
+        with timers("score"):
+            match_scores = ((np.einsum("ij,ij->i", ink, target[views]) + self.match_offset[views])
+                            / self.match_total[views])
+            mismatch_scores = np.einsum("ij,ij->i", ink, background[views]) / self.mismatch_total[views]
+            return match_scores - mismatch_scores * self.fitness_function_factor
 
-    def fitness_function(self, configuration):
+
+    def fitness_function(self, configuration, threshold=None):
+        """
+        return the fitness of the configuration, if a threshold is given the remaining
+        views are skipped as soon as the fitness cannot reach it anymore: self.partial
+        is set and the returned value is only an upper bound (below the threshold)
+        """
+        if self.vectorized and not DEBUG:
+            return self._vectorized_fitness_function(configuration, threshold)
+        if self.mask_images is None:
+            self._load_mask_images()
+        self.partial = False
         fitness = 0.0
         self.app.set_configuration(configuration)
-        for i in range(len(self.mask_images)):
+        for i in range(self.view_count):
             screenshot = self.app.make_screenshot(self.positions[i])
-            screenshot.store(self.tmp_image)
-            matchScore = self.mask_images[i].get_score(self.tmp_image)
+            with timers("store"):
+                screenshot.store(self.tmp_image)
+            with timers("threshold"):
+                matchScore = self.mask_images[i].get_score(self.tmp_image)
             if (DEBUG):
                 self.tmp_image.write(f"tmp/mask_{i}_match.png")
-            screenshot.store(self.tmp_image)
-            mismatchScore = self.inverted_mask_images[i].get_score(self.tmp_image)    
+            with timers("store"):
+                screenshot.store(self.tmp_image)
+            with timers("threshold"):
+                mismatchScore = self.inverted_mask_images[i].get_score(self.tmp_image)
             if (DEBUG):
                 self.tmp_image.write(f"tmp/mask_{i}_mismatch.png")
             score = matchScore - mismatchScore * self.fitness_function_factor
             fitness += score
-        return fitness / len(self.mask_images)
+        return fitness / self.view_count
+
+
+    def _vectorized_fitness_function(self, configuration, threshold=None):
+        self.partial = False
+        if self.tiled:
+            return self._tiled_fitness_function(configuration)
+        self.set_configuration(configuration)
+        self.rendered_views = set()
+        return self._render_remaining_views(threshold)
+
+
+    def _render_remaining_views(self, threshold=None):
+        """
+        render the views not rendered yet and return the fitness, stop early if the
+        threshold cannot be reached even with the highest possible scores of the views left
+        """
+        count = self.view_count
+        views = [i for i in range(count) if i not in self.rendered_views]
+        if threshold is not None:
+            rendered = sorted(self.rendered_views)
+            total = float(self.score_views(self.ink[rendered], rendered).sum())
+            # suffix sums: highest possible score of the views not rendered yet
+            reachable = np.cumsum(self.max_scores[views][::-1])[::-1]
+            for rendered_count, i in enumerate(views):
+                left = len(views) - rendered_count
+                bound = (total + float(reachable[rendered_count])) / count
+                if bound < threshold:
+                    self.partial = True
+                    self.early_exits += 1
+                    self.skipped_views += left
+                    return bound
+                self.render_view(i)
+                self.rendered_views.add(i)
+                total += float(self.score_views(self.ink[i:i + 1], slice(i, i + 1))[0])
+        else:
+            for i in views:
+                self.render_view(i)
+            self.rendered_views.update(views)
+        return float(self.score_views(self.ink).mean())
+
+
+    def set_configuration(self, configuration):
+        self.app.set_configuration(configuration)
+
+
+    def render_view(self, i):
+        """
+        render view i of the current configuration into self.ink[i]
+        """
+        screenshot = self.app.make_screenshot(self.positions[i])
+        with timers("readback"):
+            texture_to_ink(screenshot, out=self.ink[i])
+
+
+    def coarse_fitness(self, configuration):
+        """
+        return an estimate of the fitness from every third view only (first stage of
+        a cascade evaluation), refine_fitness() renders the remaining views
+        """
+        assert self.vectorized, "Cascade evaluation requires vectorized scoring"
+        # a tiled frame renders all views, rejecting after it would save nothing
+        assert not self.tiled, "Cascade evaluation does not support tiled rendering"
+        views = list(range(0, self.view_count, 3))
+        self.set_configuration(configuration)
+        for i in views:
+            self.render_view(i)
+        self.rendered_views = set(views)
+        return float(self.score_views(self.ink[views], views).mean())
+
+
+    def refine_fitness(self, threshold=None):
+        """
+        return the fitness of the configuration of the last call to coarse_fitness(),
+        threshold as for fitness_function()
+        """
+        self.partial = False
+        return self._render_remaining_views(threshold)
+
+
+    def _tiled_fitness_function(self, configuration):
+        self.app.set_configuration(configuration)
+        screenshot = self.app.make_tiled_screenshot()
+        with timers("readback"):
+            texture_to_ink(screenshot, out=self.tile_ink)
+        # cut the tiles out of the buffer: (rows, height, columns, width) -> (views, pixels)
+        rows, columns = self.app.tile_layout
+        width, height = self.tile_size
+        tiles = self.tile_ink.reshape(rows, height, columns, width).transpose(0, 2, 1, 3)
+        self.ink[:] = tiles.reshape(rows * columns, height * width)[:self.view_count]
+        return float(self.score_views(self.ink).mean())
+
+
+class CascadeEvaluator():
+    """
+    Two stage evaluation: a configuration is first scored cheaply (coarse_fitness(),
+    e.g. fewer views or a lower resolution), the full evaluation is only done if the
+    optimistic estimate (coarse score plus the largest underestimation of the full
+    fitness seen recently) could still reach the cutoff.
+    """
+
+    def __init__(self, fitness, window=200, warmup=20, early_exit=False):
+        self.fitness = fitness
+        self.early_exit = early_exit  # pass the cutoff to the full evaluation as threshold
+        self.deviations = deque(maxlen=window)  # full fitness - coarse estimate
+        self.warmup = warmup
+        self.coarse_evaluations = 0
+        self.full_evaluations = 0
+        self.rejected = 0
+
+
+    def evaluate(self, configuration, cutoff=None):
+        """
+        return the fitness and whether it is exact (False: rejected after the coarse stage)
+        """
+        estimate = self.fitness.coarse_fitness(configuration)
+        self.coarse_evaluations += 1
+        if (cutoff is not None and len(self.deviations) >= self.warmup
+                and estimate + max(self.deviations) < cutoff):
+            self.rejected += 1
+            # the bound, below the cutoff (the estimate is above it if the deviations are negative)
+            return estimate + max(self.deviations), False
+        fitness = self.fitness.refine_fitness(cutoff if self.early_exit else None)
+        if self.fitness.partial:
+            return fitness, False
+        self.full_evaluations += 1
+        self.deviations.append(fitness - estimate)
+        return fitness, True
+
+
+    def saved_rate(self):
+        """
+        return the rate of full evaluations saved by rejecting after the coarse stage
+        """
+        return CascadeEvaluator.saved(self.counters())
+
+
+    def counters(self):
+        return {"coarse_evaluations": self.coarse_evaluations, "full_evaluations": self.full_evaluations,
+                "rejected": self.rejected}
+
+
+    @staticmethod
+    def saved(counters):
+        """
+        return the rate of saved full evaluations given the counters of one or more evaluators (see counters())
+        """
+        return counters["rejected"] / counters["coarse_evaluations"] if counters["coarse_evaluations"] else 0.0
+
+
+    @staticmethod
+    def summary(counters):
+        return (f'Cascade(coarse={counters["coarse_evaluations"]}, full={counters["full_evaluations"]}, '
+                f'saved full evaluations={counters["rejected"]} ({CascadeEvaluator.saved(counters) * 100:.1f}%))')
+
+
+    def __str__(self):
+        return CascadeEvaluator.summary(self.counters())
+
+
+class PipelinedEvaluator():
+    """
+    Evaluates configurations with the renderer of a FitnessFunction as a pipeline: the
+    calling thread (which owns the graphics context) builds the scene and renders the
+    views, threads convert and score the rendered views (NumPy releases the GIL).
+    The stages are connected by a bounded queue, so scoring view i overlaps rendering
+    view i + 1 and the scene of the next configuration, while the renderer never gets
+    more than queue_size views ahead.
+    """
+
+    def __init__(self, fitness, threads=2, queue_size=8):
+        assert fitness.vectorized and not fitness.tiled, "Pipelining requires vectorized scoring of single views"
+        self.fitness = fitness
+        self.queue_size = queue_size
+        self.views = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.error = None
+        # occupancy: busy time of each stage relative to the elapsed time of evaluate()
+        self.elapsed = 0.0
+        self.render_seconds = 0.0
+        self.stalled_seconds = 0.0  # renderer waiting for a free slot in the queue
+        self.score_seconds = 0.0
+        self.queued_views = 0
+        self.queue_fill = 0
+        self.threads = [threading.Thread(target=self._score_views, daemon=True) for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+
+    def evaluate(self, configurations):
+        """
+        return the fitness of each configuration
+        """
+        app = self.fitness.app
+        scores = np.empty((len(configurations), self.fitness.view_count))
+        start = perf_counter()
+        for k, configuration in enumerate(configurations):
+            render_start = perf_counter()
+            self.fitness.set_configuration(configuration)
+            for i, degrees in enumerate(self.fitness.positions):
+                screenshot = app.make_screenshot(degrees)
+                # the screenshot texture is reused by the next frame, so its RAM image is copied
+                ram = np.frombuffer(screenshot.getRamImage(), dtype=np.uint8).copy()
+                ram = ram.reshape(-1, screenshot.getNumComponents())
+                put_start = perf_counter()
+                self.render_seconds += put_start - render_start
+                self.queue_fill += self.views.qsize()
+                self.queued_views += 1
+                self.views.put((scores, k, i, ram))
+                render_start = perf_counter()
+                self.stalled_seconds += render_start - put_start
+        self.views.join()
+        self.elapsed += perf_counter() - start
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return scores.mean(axis=1).tolist()
+
+
+    def _score_views(self):
+        while True:
+            scores, k, i, ram = self.views.get()
+            start = perf_counter()
+            try:
+                ink = ram_to_ink(ram)
+                scores[k, i] = self.fitness.score_views(ink[None, :], slice(i, i + 1))[0]
+            except Exception as e:
+                self.error = e
+            finally:
+                with self.lock:
+                    self.score_seconds += perf_counter() - start
+                self.views.task_done()
+
+
+    def __str__(self):
+        elapsed = self.elapsed or 1.0
+        fill = self.queue_fill / self.queued_views if self.queued_views else 0.0
+        return (f'Pipeline(render busy={self.render_seconds / elapsed * 100:.1f}%, '
+                f'render stalled={self.stalled_seconds / elapsed * 100:.1f}%, '
+                f'scoring busy={self.score_seconds / elapsed / len(self.threads) * 100:.1f}% '
+                f'of {len(self.threads)} threads, queue fill={fill:.1f}/{self.queue_size})')
+
+
+class SurrogateModel():
+    """
+    Cheap prediction of the fitness, trained online (ridge regression) on the evaluated
+    configurations. The features are per view the estimated ink of the digits on the target
+    and on the background: each digit's apparent area (from its projected center, size and
+    orientation) is added to its block of 2^level x 2^level pixels, blocks saturate.
+    The predictions are only trusted (active) while their rank correlation with the real
+    fitness is at least min_correlation, tracked on a random sample (audit_rate) of the
+    configurations, which are evaluated even if not predicted to be among the best.
+    """
+
+    def __init__(self, mask_image_paths, camera_distance=-60, mask_store=None, level=3, window=2000,
+                 warmup=100, min_correlation=0.3, field_of_view=30.0, audit_rate=0.2):
+        if mask_store is not None:
+            mask_ink = np.asarray(mask_store["ink"])
+            self.image_size = mask_store.size
+        else:
+            images = [MaskImage(path) for path in mask_image_paths]
+            mask_ink = np.stack([image.get_ink() for image in images])
+            self.image_size = (images[0].image.getXSize(), images[0].image.getYSize())
+        width, height = self.image_size
+        target = (mask_ink > 0.1).astype(np.float32)  # see FitnessFunction._prepare_masks()
+        self.level = level
+        self.block_area = 4 ** level
+        self.columns = width >> level
+        # per block the fraction of target (background) pixels, relative to the total of
+        # the view like the match (mismatch) score of FitnessFunction.score_views()
+        self.target = (pool_masks(target, self.image_size, level)
+                       / self.block_area / mask_ink.sum(axis=1)[:, None])
+        self.background = (pool_masks(1.0 - target, self.image_size, level)
+                           / self.block_area / (1.0 - target).sum(axis=1)[:, None])
+        view_count = len(mask_ink)
+        self.positions = np.radians(np.arange(view_count) * 360.0 / view_count)[:, None, None]
+        self.camera_distance = camera_distance
+        self.tan_x = tan(radians(field_of_view / 2))
+        self.tan_z = self.tan_x * height / width
+        self.samples = deque(maxlen=window)  # (features, fitness)
+        self.warmup = warmup
+        self.min_correlation = min_correlation
+        self.audit_rate = audit_rate
+        self.mean = self.scale = self.weights = None
+        self.correlation = None  # rank correlation of the last tracked predictions
+        self.predictions = 0
+        self.screened = 0
+
+
+    def features(self, configurations):
+        """
+        return the features of the configurations as array of shape (configurations, 2 * views)
+        """
+        genes = np.asarray(configurations, dtype=np.float64).reshape(len(configurations), -1, 6)
+        x, y, z = (genes[:, :, i] / SIZE_SCALE for i in (1, 2, 3))
+        heading = np.radians(genes[:, :, 5])
+        # camera space of every view (views, configurations, genes), see Rasterizer.fragments()
+        c = np.cos(self.positions)
+        s = np.sin(self.positions)
+        camera_x = x * c - y * s
+        depth = x * s + y * c - self.camera_distance
+        visible = depth > 1.0
+        depth = np.where(visible, depth, 1.0)
+        distance = np.sqrt(camera_x ** 2 + depth ** 2 + z ** 2)
+        facing = np.abs(np.cos(heading + self.positions) * depth - np.sin(heading + self.positions) * camera_x)
+        width, height = self.image_size
+        pixel_x = ((camera_x / depth / self.tan_x + 1) * 0.5 * width).astype(np.intp)
+        pixel_z = ((z / depth / self.tan_z + 1) * 0.5 * height).astype(np.intp)
+        area = ((genes[:, :, 4] / SIZE_SCALE) ** 2 * facing / distance / depth ** 2
+                * (0.5 * width / self.tan_x) * (0.5 * height / self.tan_z))
+        inside = visible & (pixel_x >= 0) & (pixel_x < width) & (pixel_z >= 0) & (pixel_z < height)
+        blocks = self.target.shape[1]
+        block = (pixel_z >> self.level) * self.columns + (pixel_x >> self.level)
+        index = np.arange(visible.shape[0] * visible.shape[1]).reshape(visible.shape[:2] + (1,)) * blocks + block
+        coverage = np.bincount(index[inside], weights=area[inside], minlength=visible.shape[0] * visible.shape[1] * blocks)
+        coverage = self.block_area * -np.expm1(-coverage.reshape(visible.shape[:2] + (blocks,)) / self.block_area)
+        return np.hstack([np.einsum("vnb,vb->nv", coverage, self.target),
+                          np.einsum("vnb,vb->nv", coverage, self.background)])
+
+
+    def predict(self, features):
+        """
+        return the predicted fitness for the features, None before the warmup is over
+        """
+        if self.weights is None:
+            return None
+        self.predictions += len(features)
+        return ((features - self.mean) / self.scale) @ self.weights[1:] + self.weights[0]
+
+
+    def train(self, features, fitness):
+        self.samples.extend(zip(features, fitness))
+        if len(self.samples) < self.warmup:
+            return
+        X = np.array([sample[0] for sample in self.samples])
+        y = np.array([sample[1] for sample in self.samples])
+        self.mean = X.mean(axis=0)
+        self.scale = X.std(axis=0) + 1e-12
+        X = np.hstack([np.ones((len(X), 1)), (X - self.mean) / self.scale])
+        regularization = np.eye(X.shape[1]) * len(X)  # strong, the features are noisy estimates
+        regularization[0, 0] = 0.0  # the intercept is not regularized
+        self.weights = np.linalg.solve(X.T @ X + regularization, X.T @ y)
+
+
+    def track(self, predictions, fitness):
+        """
+        update the rank correlation (Spearman) of the predictions with the real fitness
+        """
+        if len(predictions) < 3:
+            return
+        ranks = [np.argsort(np.argsort(values)) for values in (predictions, fitness)]
+        self.correlation = float(np.corrcoef(ranks[0], ranks[1])[0, 1])
+
+
+    @property
+    def active(self):
+        return self.correlation is not None and self.correlation >= self.min_correlation
+
+
+    def __str__(self):
+        correlation = "n/a" if self.correlation is None else f"{self.correlation:.3f}"
+        return (f'Surrogate(active={self.active}, rank correlation={correlation}, samples={len(self.samples)}, '
+                f'predictions={self.predictions}, screened={self.screened})')
+
+
+class FitnessCache():
+    """
+    Fitness values keyed by a hash of the genom, so that identical genoms are
+    evaluated only once (across generations and, if a directory is given, across runs).
+    The on-disk store is a SQLite file per combination of fitness settings, shared by
+    processes (workers, islands, runs): new values are written in short transactions of
+    up to BATCH_SIZE values, so that the file is never locked for long.
+    """
+
+    BATCH_SIZE = 256
+    # seconds to wait for a write lock held by another process
+    TIMEOUT = 30.0
+
+    def __init__(self, max_entries=100000, directory=None, settings=()):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        self.pending = []  # values not written to the database yet
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.path = os.path.join(directory, f"fitness-{FitnessCache.settings_key(settings)}.sqlite")
+            self.db = sqlite3.connect(self.path, timeout=FitnessCache.TIMEOUT)
+            # readers do not block the writer (and vice versa)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            with self.db:
+                self.db.execute("CREATE TABLE IF NOT EXISTS fitness (genom BLOB PRIMARY KEY, fitness REAL)")
+
+
+    @staticmethod
+    def settings_key(settings):
+        """
+        return a hash of the fitness settings, files (e.g. target images) are hashed by content
+        """
+        digest = hashlib.blake2b(digest_size=8)
+        for setting in settings:
+            if isinstance(setting, str) and os.path.isfile(setting):
+                with open(setting, "rb") as f:
+                    digest.update(f.read())
+            else:
+                digest.update(repr(setting).encode())
+        return digest.hexdigest()
+
+
+    @staticmethod
+    def genom_key(genom):
+        return hashlib.blake2b(np.asarray(genom, dtype=np.int32).tobytes(), digest_size=16).digest()
+
+
+    def get(self, key):
+        fitness = self.entries.get(key)
+        if fitness is None and self.db is not None:
+            row = self.db.execute("SELECT fitness FROM fitness WHERE genom = ?", (key,)).fetchone()
+            if row is not None:
+                fitness = row[0]
+                self._remember(key, fitness)
+        if fitness is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return fitness
+
+
+    def put(self, key, fitness):
+        self._remember(key, fitness)
+        if self.db is not None:
+            self.pending.append((key, fitness))
+            if len(self.pending) >= FitnessCache.BATCH_SIZE:
+                self.flush()
+
+
+    def _remember(self, key, fitness):
+        self.entries[key] = fitness
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+    def cached(self, fitness_function):
+        """
+        return a fitness function that looks up the cache before calling fitness_function
+        """
+        def cached_fitness_function(genom):
+            key = FitnessCache.genom_key(genom)
+            fitness = self.get(key)
+            if fitness is None:
+                fitness = fitness_function(genom)
+                self.put(key, fitness)
+            return fitness
+        return cached_fitness_function
+
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+    def export(self):
+        """
+        return the cached entries as arrays (keys as rows of bytes, fitness values)
+        """
+        keys = np.frombuffer(b"".join(self.entries.keys()), dtype=np.uint8).reshape(len(self.entries), -1)
+        return keys, np.fromiter(self.entries.values(), dtype=np.float64, count=len(self.entries))
+
+
+    def restore(self, keys, fitness):
+        for key, value in zip(keys, fitness):
+            self._remember(key.tobytes(), float(value))
+
+
+    def flush(self):
+        """
+        write the pending values to the database (one transaction)
+        """
+        if self.db is not None and self.pending:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO fitness VALUES (?, ?)", self.pending)
+            self.pending.clear()
+
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
@@ -1,11 +1,21 @@
-from random import random, randint, sample
+from random import random, randint, sample, choice, getstate, setstate
+import multiprocessing
+import threading
+import heapq
 import os
+import queue
 import json
 import sys
+import traceback
+from collections import Counter, deque
+from itertools import count
 from time import time
-from math import sqrt, sin, cos, pi
+from math import sqrt, sin, cos, pi, exp
+import numpy as np
 import visualization
-from fitness import FitnessFunction
+from fitness import CascadeEvaluator, FitnessCache, FitnessFunction, MaskStore, PipelinedEvaluator, SurrogateModel
+from rasterizer import FootprintCache, RasterFitnessFunction, IncrementalFitnessFunction
+from telemetry import TelemetryLog, max_rss_mb, timers
 from dotenv import load_dotenv
 from random import random, randint
 
@@ -52,6 +62,97 @@ MAX_SCALE = 6000
 # prefer less visual noise around image
 FITNESS_FUNCTION_FACTOR = 1.1
 
+# render all views of the fitness function in one frame (tiled offscreen buffer)
+TILED_RENDERING = False
+
+# draw all digits as one geom with a texture atlas (one draw call per view instead of two
+# per gene), "panda" backend without TILED_RENDERING
+ATLAS_RENDERING = False
+
+# how to render the views for the fitness function:
+# "panda" (Panda3D, needs an OpenGL context), "raster" (NumPy software rasterizer)
+# or "incremental" (software rasterizer, only re-renders genes changed since the last evaluation)
+FITNESS_BACKEND = "panda"
+
+# memory (in MB) of the LRU cache of rasterized gene footprints used by the
+# "raster" and "incremental" backends, 0 disables the cache
+FOOTPRINT_CACHE_MB = 256
+
+# number of fitness values cached by genom (in memory), 0 disables the cache
+FITNESS_CACHE_SIZE = 100000
+
+# directory to persist the fitness cache in (one file per fitness settings),
+# empty for no persistence
+FITNESS_CACHE_DIR = ""
+
+# score children cheaply first (half resolution, or every third view with "panda"),
+# the full evaluation is only done if a child could still beat the worst survivor
+CASCADE_EVALUATION = False
+
+# stop rendering the views of a child as soon as it cannot beat the worst survivor
+# anymore (even if all remaining views would match perfectly)
+EARLY_EXIT = False
+
+# precompiled target masks (compiled on first use or when the images changed),
+# memory-mapped and shared by all processes, empty to decode the images instead
+MASK_STORE = ""
+
+# number of worker processes evaluating individuals in parallel (each with its own
+# headless renderer), 0 evaluates in the main process
+WORKERS = 0
+
+# number of islands (independent populations, one process each), 0 runs a single population
+ISLANDS = 0
+
+# islands send their best MIGRANTS survivors every MIGRATION_INTERVAL generations
+# to their neighbours: "ring" (next island), "all" (every other island) or "random"
+MIGRATION_INTERVAL = 25
+MIGRANTS = 4
+MIGRATION_TOPOLOGY = "ring"
+
+# store the genoms of a generation in one int32 array and breed/mutate vectorized
+ARRAY_POPULATION = False
+
+# file to save the state of the run to every CHECKPOINT_INTERVAL generations
+# (empty for no checkpoints), start with --resume to continue from it
+CHECKPOINT = ""
+CHECKPOINT_INTERVAL = 10
+RESUME = False
+
+# steady-state GA instead of generations: every finished evaluation goes straight into
+# the survivors and children are bred on demand to keep all evaluators (WORKERS) busy
+STEADY_STATE = False
+
+# rank the children with a cheap surrogate model (trained on the evaluated individuals)
+# and only evaluate the best SURROGATE_KEEP of them, the surrogate is switched off while
+# the rank correlation of its predictions with the real fitness is below SURROGATE_MIN_CORRELATION
+SURROGATE = False
+SURROGATE_KEEP = 0.5
+SURROGATE_MIN_CORRELATION = 0.3
+
+# memetic local search: every generation the best MEMETIC_ELITE survivors are improved by
+# single gene mutations, MEMETIC_BUDGET fitness evaluations each (cheap with the "incremental"
+# backend or the fitness cache). hill climbing, or simulated annealing starting at
+# MEMETIC_TEMPERATURE (fitness difference) if > 0. MEMETIC_ELITE = 0 disables the local search
+MEMETIC_ELITE = 0
+MEMETIC_BUDGET = 20
+MEMETIC_TEMPERATURE = 0.0
+
+# JSONL file to append a record per generation to: time per stage of the GA loop
+# (breeding, rendering, scoring, ...), evaluations/sec, cache hits and memory high-water mark.
+# the stage timers are only enabled with a file, empty disables the telemetry
+TELEMETRY = ""
+
+# score the rendered views on PIPELINE_THREADS threads while the next views are rendered
+# ("panda" backend without tiled rendering), at most PIPELINE_QUEUE views wait for scoring.
+# 0 renders and scores the views one after the other
+PIPELINE_THREADS = 0
+PIPELINE_QUEUE = 8
+
+# evaluate the children of a generation in an order where consecutive genoms share as many
+# genes as possible, the renderers only update the nodes (fragments) of the changed genes
+ORDER_EVALUATIONS = False
+
 Q = RADIUS // QUANTIZATION # the following condition should hold: Q * QUANTIZATION == RADIUS 
 
 class Individual:
@@ -59,6 +160,7 @@ class Individual:
     def __init__(self, genom):
         self.genom = genom
         self.fitness = None
+        self.estimated = False  # fitness is only an estimate (cascade rejection or early exit)
 
 
     def _random_point():
@@ -75,9 +177,10 @@ class Individual:
 
 
     def create_random_gene():
-        # [digit, x, y, z, size, heading_degrees]
+        # (digit, x, y, z, size, heading_degrees)
+        # genes are immutable tuples, so that individuals can share them (see breed(), copy())
         x, y, z = Individual._random_point()
-        return [randint(0, 9), x, y, z, randint(MIN_SCALE, MAX_SCALE), randint(0, 359)]
+        return (randint(0, 9), x, y, z, randint(MIN_SCALE, MAX_SCALE), randint(0, 359))
 
 
     @staticmethod
@@ -120,6 +223,7 @@ class Individual:
         # A mutation should be small, e.g. position +/- 1000, size +/- 100, heading +/- 20 degrees.
         # Make sure to keep parameters within valid ranges
         self.fitness = None  # reset cached fitness
+        self.estimated = False
         for _ in range(count):
             index = randint(0, len(self.genom) - 1)
             choice = random()
@@ -129,8 +233,10 @@ class Individual:
             else:
                 # Mutate a parameter
                 # [0: digit, 1: x, 2: y, 3: z, 4: size, 5: heading_degrees]
+                # the gene may be shared with other individuals (e.g. the parents),
+                # so it is replaced by a changed copy instead of changed in place
                 pos = randint(0, 5)
-                gene = self.genom[index]
+                gene = list(self.genom[index])
                 if pos == 0:
                     gene[0] = randint(0, 9)
                 elif pos in [1, 2, 3]:
@@ -143,10 +249,12 @@ class Individual:
                 elif pos == 5:
                     gene[5] += randint(-20, 20)
                     gene[5] = gene[5] % 360
+                self.genom[index] = tuple(gene)
         return self
     
     
     def copy(self):
+        # shallow copy: the genes are shared, but never changed in place (see mutate())
         return Individual(self.genom.copy())
 
 
@@ -158,76 +266,807 @@ class Individual:
         return f'Individual(fitness={self.fitness}, len={len(self.genom)})'
 
 
+# odd multipliers of the gene parameters for a 64 bit hash of a gene (see Population.similarity_order())
+_GENE_HASH = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9,
+                       0xD6E8FEB86659FD93, 0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53], dtype=np.uint64).astype(np.int64)
+
+
+class Population:
+    """
+    Genoms of many individuals in one int32 array of shape (individuals, genes, 6)
+    with vectorized versions of the operators of Individual. The genoms of the
+    individuals returned by individuals() are views into this array.
+    """
+
+    rng = np.random.default_rng()
+
+    def __init__(self, genes):
+        self.genes = genes
+
+
+    def __len__(self):
+        return len(self.genes)
+
+
+    def individuals(self):
+        return [Individual(genom) for genom in self.genes]
+
+
+    @staticmethod
+    def from_individuals(individuals):
+        return Population(np.array([individual.genom for individual in individuals], dtype=np.int32))
+
+
+    @staticmethod
+    def from_json(data):
+        return Population(np.array(data, dtype=np.int32).reshape(len(data), -1, 6))
+
+
+    @staticmethod
+    def similarity_order(genoms, neighbours=8, max_owners=32):
+        """
+        return an order of the genoms (indices) where consecutive genoms share many genes:
+        greedy nearest neighbour path, starting at the first, to the unvisited one of the
+        neighbours (genoms sharing the most genes) of each genom, else to the next unvisited.
+        Shared genes are counted via the genoms owning each gene, genes owned by more than
+        max_owners genoms are skipped (little information, quadratic work).
+        """
+        if len(genoms) < 3:
+            return list(range(len(genoms)))
+        # genes are keyed by a 64 bit hash, a rare collision only changes the order
+        owners = {}
+        for i, genom in enumerate(genoms):
+            keys = np.asarray(genom, dtype=np.int64).reshape(-1, 6) @ _GENE_HASH
+            for key in set(keys.tolist()):
+                owners.setdefault(key, []).append(i)
+        # count the genes shared by each pair of genoms (as pair index i*n + j)
+        n = len(genoms)
+        pairs = [(members[:, None] * n + members).ravel()
+                 for members in map(np.array, owners.values()) if 1 < len(members) <= max_owners]
+        pairs, counts = np.unique(np.concatenate(pairs or [np.zeros(0, dtype=np.int64)]), return_counts=True)
+        nearest = [[] for _ in genoms]
+        for pair in np.lexsort((-counts, pairs // n)).tolist():
+            i, j = divmod(pairs[pair], n)
+            if i != j and len(nearest[i]) < neighbours:
+                nearest[i].append(int(j))
+        visited = [False] * len(genoms)
+        order = [0]
+        visited[0] = True
+        next_unvisited = 1
+        for _ in range(len(genoms) - 1):
+            following = next((j for j in nearest[order[-1]] if not visited[j]), None)
+            if following is None:
+                while visited[next_unvisited]:
+                    next_unvisited += 1
+                following = next_unvisited
+            order.append(following)
+            visited[following] = True
+        return order
+
+
+    @staticmethod
+    def to_json(genom):
+        """
+        return the genom (list or array) in the JSON format of winner files (list of lists)
+        """
+        return np.asarray(genom).tolist()
+
+
+    @staticmethod
+    def random_genes(count):
+        """
+        return count random genes as array of shape (count, 6), see Individual.create_random_gene()
+        """
+        rng = Population.rng
+        points = np.empty((0, 3))
+        while len(points) < count:
+            candidates = rng.random((2 * (count - len(points)) + 8, 3)) * 2 - 1
+            points = np.concatenate([points, candidates[(candidates ** 2).sum(axis=1) <= 1]])
+        genes = np.empty((count, 6), dtype=np.int32)
+        genes[:, 0] = rng.integers(0, 10, count)
+        genes[:, 1:4] = np.trunc(points[:count] * Q) * QUANTIZATION
+        genes[:, 4] = rng.integers(MIN_SCALE, MAX_SCALE + 1, count)
+        genes[:, 5] = rng.integers(0, 360, count)
+        return genes
+
+
+    @staticmethod
+    def random(count, size_of_genom):
+        genes = Population.random_genes(count * size_of_genom).reshape(count, size_of_genom, 6)
+        # sort by x, y like Individual.random_individual()
+        order = np.lexsort((genes[:, :, 2], genes[:, :, 1]), axis=-1)
+        return Population(np.take_along_axis(genes, order[:, :, None], axis=1))
+
+
+    @staticmethod
+    def breed(parents, count):
+        """
+        return count children, each made of similar amounts of genes of up to
+        MAX_PARENTS random parents (N-way crossover like Individual.breed())
+        """
+        rng = Population.rng
+        size = parents.genes.shape[1]
+        n = min(MAX_PARENTS, len(parents))
+        chosen = np.argsort(rng.random((count, len(parents))), axis=1)[:, :n]
+        genes_per_parent = size // n
+        takes = [genes_per_parent] * (n - 1) + [size - genes_per_parent * (n - 1)]
+        children = []
+        for j, take in enumerate(takes):
+            picks = np.argsort(rng.random((count, size)), axis=1)[:, :take]
+            children.append(parents.genes[chosen[:, j, None], picks])
+        return Population(np.concatenate(children, axis=1))
+
+
+    def mutate(self, rows):
+        """
+        mutate one random gene of each given individual (rows may repeat), with the
+        same kind of mutations and limits as Individual.mutate()
+        """
+        rng = Population.rng
+        genes = rng.integers(0, self.genes.shape[1], len(rows))
+        replace = rng.random(len(rows)) < 0.1
+        self.genes[rows[replace], genes[replace]] = Population.random_genes(int(replace.sum()))
+        rows, genes = rows[~replace], genes[~replace]
+        count = len(rows)
+        pos = rng.integers(0, 6, count)
+        values = self.genes[rows, genes, pos].astype(np.int64)
+        values = np.select(
+            [pos == 0, pos <= 3, pos == 4, pos == 5],
+            [rng.integers(0, 10, count),
+             np.clip(values + rng.integers(-1000, 1001, count), -RADIUS, RADIUS),
+             np.clip(values + rng.integers(-100, 101, count), MIN_SCALE, MAX_SCALE),
+             (values + rng.integers(-20, 21, count)) % 360])
+        self.genes[rows, genes, pos] = values
+        return self
+
+
 class Genetics:
 
     def __init__(self, target_images):
         self.mutation_rate = MUTATION_RATE
         self.target_images = target_images
         self.winner = None
+        self.fitness = None
+        self.fitness_cache = None
+        self.pipeline = None
+        self.cascade = None
+        self.pool = None
+        self.worker_counters = Counter()  # counters reported by the workers (see counters())
+        self.winner_fitness = None
+        self.island = None  # (index, queues of all islands) when running as island
+        self.last_migration = 0
+        self.last_checkpoint = 0
+        self.checkpoint_writer = None
+        self.surrogate = None
+        self.evaluations = 0  # individuals actually evaluated (not taken from the cache)
+        self.logged_evaluations = 0
+        self.telemetry = None
+        self.local_search_gain = 0.0
+        self.local_search_evaluations = 0
 
 
-    def run(self, app):
+    def create_fitness(self, app):
+        cache = FootprintCache(FOOTPRINT_CACHE_MB * 2**20) if FOOTPRINT_CACHE_MB > 0 else None
+        mask_store = MaskStore.load(self.target_images, MASK_STORE) if MASK_STORE else None
+        if FITNESS_BACKEND == "raster":
+            return RasterFitnessFunction(self.target_images, FITNESS_FUNCTION_FACTOR,
+                                         CAMERA_DISTANCE, cache, mask_store)
+        if FITNESS_BACKEND == "incremental":
+            return IncrementalFitnessFunction(self.target_images, FITNESS_FUNCTION_FACTOR,
+                                              CAMERA_DISTANCE, cache, mask_store)
         app.set_camera_distance(CAMERA_DISTANCE)
-        fitness_function = FitnessFunction(app, self.target_images, FITNESS_FUNCTION_FACTOR).fitness_function
-        population = self.create_random_population(SIZE_OF_GENERATION)
+        if ATLAS_RENDERING and app.atlas is None:
+            app.setup_atlas()
+        return FitnessFunction(app, self.target_images, FITNESS_FUNCTION_FACTOR,
+                               tiled=TILED_RENDERING, mask_store=mask_store)
+
+
+    def create_fitness_cache(self):
+        if FITNESS_CACHE_SIZE <= 0:
+            return None
+        settings = self.target_images + [CAMERA_DISTANCE, FITNESS_FUNCTION_FACTOR, FITNESS_BACKEND]
+        return FitnessCache(FITNESS_CACHE_SIZE, FITNESS_CACHE_DIR, settings)
+
+
+    def setup_evaluation(self, app=None):
+        self.fitness = self.create_fitness(app)
+        if CASCADE_EVALUATION and self.fitness.exact_coarse_fitness:
+            print(f"Info: No cascade evaluation, the coarse stage of the \"{FITNESS_BACKEND}\" backend is exact.")
+        elif CASCADE_EVALUATION:
+            self.cascade = CascadeEvaluator(self.fitness, early_exit=EARLY_EXIT)
+        elif PIPELINE_THREADS > 0:
+            self.pipeline = PipelinedEvaluator(self.fitness, PIPELINE_THREADS, PIPELINE_QUEUE)
+
+
+    def run(self, app=None):
+        if WORKERS > 0:
+            if MASK_STORE:
+                MaskStore.load(self.target_images, MASK_STORE)  # compile once, not in every worker
+            # workers need their own renderer, settings are passed since .env may be overridden
+            settings = {name: value for name, value in globals().items() if name.isupper()}
+            self.pool = multiprocessing.get_context("spawn").Pool(
+                WORKERS, initializer=_init_worker, initargs=(self.target_images, settings))
+        else:
+            self.setup_evaluation(app)
+        self.fitness_cache = self.create_fitness_cache()
+        if TELEMETRY:
+            timers.enabled = True
+            self.telemetry = TelemetryLog(TELEMETRY)
+        if SURROGATE:
+            mask_store = MaskStore.load(self.target_images, MASK_STORE) if MASK_STORE else None
+            self.surrogate = SurrogateModel(self.target_images, CAMERA_DISTANCE, mask_store,
+                                            min_correlation=SURROGATE_MIN_CORRELATION)
+        try:
+            population = None
+            if RESUME and os.path.isfile(self.checkpoint_path()):
+                population = self.load_checkpoint()
+            if STEADY_STATE:
+                self.evolve_steady_state(population)
+            else:
+                self.evolve(population)
+        finally:
+            if self.checkpoint_writer is not None:
+                self.checkpoint_writer.join()
+            if self.telemetry is not None:
+                self.telemetry.close()
+            if self.pool is not None:
+                self.pool.terminate()
+            if self.fitness_cache is not None:
+                self.fitness_cache.close()
+            counters = self.counters()
+            if counters["coarse_evaluations"]:
+                print(f"Info: {CascadeEvaluator.summary(counters)}")
+            if self.surrogate is not None:
+                print(f"Info: {self.surrogate}")
+            if self.pipeline is not None:
+                print(f"Info: {self.pipeline}")
+            if self.local_search_evaluations:
+                print(f"Info: Local search: +{self.local_search_gain:.5f} fitness in "
+                      f"{self.local_search_evaluations} evaluations "
+                      f"({self.local_search_gain / self.local_search_evaluations:.2e} per evaluation)")
+            if counters["configurations"]:
+                print(f"Info: Node updates: {counters['node_updates'] / counters['configurations']:.1f} "
+                      f"per evaluation")
+            if EARLY_EXIT:
+                print(f"Info: Early exits: {counters['early_exits']}, skipped views: {counters['skipped_views']}")
+
+
+    def counters(self):
+        """
+        return the counters of the evaluations in this process (cascade, early exits, node updates)
+        plus the counters reported by the workers
+        """
+        counters = Counter(self.worker_counters)
+        if self.cascade is not None:
+            counters.update(self.cascade.counters())
+        if self.fitness is not None:
+            counters.update(early_exits=self.fitness.early_exits, skipped_views=self.fitness.skipped_views)
+            app = getattr(self.fitness, "app", None)
+            if app is not None:
+                counters.update(node_updates=app.node_updates, configurations=app.configurations)
+        return counters
+
+
+    def evaluate(self, genom, cutoff=None):
+        """
+        return the fitness of the genom and whether it is only an estimate
+        """
+        with timers("evaluate"):
+            if self.cascade is not None:
+                fitness, exact = self.cascade.evaluate(genom, cutoff)
+            elif self.pipeline is not None:
+                fitness, exact = self.pipeline.evaluate([genom])[0], True
+            else:
+                fitness = self.fitness.fitness_function(genom, cutoff if EARLY_EXIT else None)
+                exact = not self.fitness.partial
+        return fitness, not exact
+
+
+    def evaluate_population(self, population):
+        # individuals carried over are already evaluated: a child can only survive if
+        # it beats the worst of the best num_survivors of them (cutoff for the cascade)
+        num_survivors = int(SIZE_OF_GENERATION * SURVIVOR_RATE)
+        evaluated = sorted((ind.fitness for ind in population if ind.fitness is not None and not ind.estimated),
+                           reverse=True)
+        cutoff = evaluated[num_survivors - 1] if len(evaluated) >= num_survivors else None
+        pending = []
+        keys = []
+        with timers("cache"):
+            for individual in population:
+                if individual.fitness is None:
+                    key = None
+                    if self.fitness_cache is not None:
+                        key = FitnessCache.genom_key(individual.genom)
+                        individual.fitness = self.fitness_cache.get(key)
+                    if individual.fitness is None:
+                        pending.append(individual)
+                        keys.append(key)
+        if ORDER_EVALUATIONS and pending:
+            with timers("order"):
+                order = Population.similarity_order([individual.genom for individual in pending])
+            pending = [pending[i] for i in order]
+            keys = [keys[i] for i in order]
+        screened = []
+        if self.surrogate is not None and pending:
+            with timers("surrogate"):
+                features = self.surrogate.features([individual.genom for individual in pending])
+                predictions = self.surrogate.predict(features)
+            audited = np.ones(len(pending), dtype=bool)  # children the predictions are tracked on
+            if predictions is not None and self.surrogate.active:
+                # only the most promising children are evaluated, at least as many as needed to
+                # fill the survivors with evaluated individuals (screened children never survive),
+                # plus a random sample of all children to track the predictions without the
+                # bias of this selection
+                exact_count = sum(1 for ind in population if ind.fitness is not None and not ind.estimated)
+                keep = max(1, int(len(pending) * SURROGATE_KEEP), num_survivors - exact_count)
+                audit_size = min(len(pending), max(3, int(len(pending) * self.surrogate.audit_rate)))
+                audited[:] = False
+                audited[sample(range(len(pending)), audit_size)] = True
+                chosen = audited.copy()
+                chosen[np.argsort(-predictions, kind="stable")[:keep]] = True
+                kept = np.flatnonzero(chosen)
+                screened = [(pending[i], predictions[i]) for i in np.flatnonzero(~chosen)]
+                pending = [pending[i] for i in kept]
+                keys = [keys[i] for i in kept]
+                features = features[kept]
+                predictions = predictions[kept]
+                audited = audited[kept]
+                self.surrogate.screened += len(screened)
+        self.evaluations += len(pending)
+        if self.pool is not None:
+            # a few batches per worker, so that workers finishing early get more work
+            size = max(1, -(-len(pending) // (WORKERS * 4)))
+            batches = [[(ind.genom, cutoff) for ind in pending[i:i + size]] for i in range(0, len(pending), size)]
+            with timers("evaluate"):
+                results = []
+                for batch_results, counters in self.pool.map(_evaluate_batch, batches):
+                    results += batch_results
+                    self.worker_counters.update(counters)
+        elif self.pipeline is not None:
+            # the whole generation goes through the pipeline (no early exit)
+            with timers("evaluate"):
+                results = [(fitness, False) for fitness in self.pipeline.evaluate([ind.genom for ind in pending])]
+        else:
+            results = [self.evaluate(individual.genom, cutoff) for individual in pending]
+        for individual, key, (fitness, estimated) in zip(pending, keys, results):
+            individual.fitness, individual.estimated = fitness, estimated
+            if not estimated and key is not None:
+                self.fitness_cache.put(key, fitness)
+        if self.surrogate is not None and pending:
+            exact = [i for i, individual in enumerate(pending) if not individual.estimated]
+            fitness = np.array([pending[i].fitness for i in exact])
+            with timers("surrogate"):
+                if predictions is not None:
+                    tracked = [j for j, i in enumerate(exact) if audited[i]]
+                    self.surrogate.track(predictions[exact][tracked], fitness[tracked])
+                self.surrogate.train(features[exact], fitness)
+        if screened:
+            # screened children are not evaluated, they rank behind all evaluated individuals
+            floor = min(individual.getFitness() for individual in population if individual.fitness is not None)
+            for individual, prediction in screened:
+                individual.fitness, individual.estimated = min(prediction, np.nextafter(floor, -np.inf)), True
+
+
+    def evolve(self, population=None):
+        if population is None:
+            population = self.create_random_population(SIZE_OF_GENERATION)
+            self.worst_survivor_fitness = -1000.0
+            self.stagnation_count = 0
+            self.generation = -1
         self.winner = population[0].genom
         print("=============================================================")
         print("starting genetic algorithm...")
         print("=============================================================")
-        worst_survivor_fitness = -1000.0
-        stagnation_count = 0
-        self.generation = -1
         while True:
+            if CHECKPOINT and self.generation - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+                with timers("checkpoint"):
+                    self.save_checkpoint(population)
             self.generation += 1
             start_time = time()
-            population.sort(key=lambda x: x.getFitness(fitness_function=fitness_function), reverse=True)
-            self.winner = population[0].genom # store the best individuals genom
+            self.evaluate_population(population)
+            with timers("sort"):
+                population.sort(key=lambda x: x.getFitness(), reverse=True)
             num_survivors = int(SIZE_OF_GENERATION * SURVIVOR_RATE)
             survivors = population[:num_survivors]
+            if MEMETIC_ELITE > 0:
+                survivors = self.local_search(survivors)
+            self.winner = survivors[0].genom # store the best individuals genom
+            self.winner_fitness = survivors[0].getFitness()
             self.log_stats(population, start_time, survivors)
             population = []
             if self.generation >= TOURNAMENT_SIZE:
                 # final generation, do not breed further
                 return
-            if worst_survivor_fitness == survivors[-1].getFitness():
-                stagnation_count += 1
+            if self.worst_survivor_fitness == survivors[-1].getFitness():
+                self.stagnation_count += 1
                 self.mutation_rate = self.mutation_rate * 1.05
-                if stagnation_count == 1:
+                if self.stagnation_count == 1:
                     # alternative breed starts from scratch
-                    print(f"Warn: Stagnation ({stagnation_count}) detected, develop new breed to mix in")
-                    survivors += self.alternative_breed(
-                        fitness_function, survivors[0].getFitness())
-                elif stagnation_count <= 3:
+                    print(f"Warn: Stagnation ({self.stagnation_count}) detected, develop new breed to mix in")
+                    survivors += self.alternative_breed(survivors[0].getFitness())
+                elif self.stagnation_count <= 3:
                     # seed alternative breed
-                    print(f"Warn: Stagnation ({stagnation_count}) detected, develop new breed to mix in")
+                    print(f"Warn: Stagnation ({self.stagnation_count}) detected, develop new breed to mix in")
                     l = len(survivors) - 1
                     survivors += self.alternative_breed(
-                        fitness_function, survivors[0].getFitness(), population=sample(survivors[1:], l // 2))
-                elif stagnation_count >= 10:
-                    print(f"Warn: Termininating after #{stagnation_count} stagnations")
+                        survivors[0].getFitness(), population=sample(survivors[1:], l // 2))
+                elif self.stagnation_count >= 10:
+                    print(f"Warn: Termininating after #{self.stagnation_count} stagnations")
+                    return
+            else:
+                self.worst_survivor_fitness = survivors[-1].getFitness()
+            if self.island is not None:
+                with timers("migrate"):
+                    survivors = self.migrate(survivors)
+            population = self.reproduce(survivors)
+
+
+    def evolve_steady_state(self, population=None):
+        """
+        steady-state GA: the survivors are a heap updated after every evaluation and children
+        are bred on demand, so there is no barrier waiting for the slowest individual.
+        a "generation" (for logging, migration and checkpoints) are SIZE_OF_GENERATION - num_survivors evaluations
+        """
+        num_survivors = int(SIZE_OF_GENERATION * SURVIVOR_RATE)
+        round_size = SIZE_OF_GENERATION - num_survivors
+        if population is None:
+            population = self.create_random_population(SIZE_OF_GENERATION)
+            self.worst_survivor_fitness = -1000.0
+            self.stagnation_count = 0
+            self.generation = -1
+        self.winner = population[0].genom
+        print("=============================================================")
+        print("starting steady-state genetic algorithm...")
+        print("=============================================================")
+        survivors = []  # min-heap of (fitness, sequence, individual), survivors[0] is the worst
+        sequence = count()
+        waiting = deque(population)  # evaluated before any child is bred
+        finished = queue.Queue()  # (individual, cache key, (fitness, estimated)) or an exception
+        in_flight = 0
+        capacity = WORKERS * 2 if self.pool is not None else 1
+        evaluated = []
+        start_time = time()
+        while True:
+            # keep the evaluators busy
+            while in_flight < capacity and (waiting or len(survivors) >= 2):
+                if waiting:
+                    individual = waiting.popleft()
+                else:
+                    parents = sample([s[2] for s in survivors], min(MAX_PARENTS, len(survivors)))
+                    if ARRAY_POPULATION:
+                        # genoms are array rows, bred and mutated like a generation of one child
+                        child = Population.breed(Population.from_individuals(parents), 1)
+                        if random() < self.mutation_rate:
+                            child.mutate(np.zeros(1, dtype=np.int64))
+                        individual = child.individuals()[0]
+                    else:
+                        individual = Individual.breed(parents)
+                        if random() < self.mutation_rate:
+                            individual.mutate()
+                if individual.fitness is not None:
+                    # carried over (resumed or immigrant), goes straight to the survivors
+                    heapq.heappush(survivors, (individual.fitness, next(sequence), individual))
+                    continue
+                key = None
+                if self.fitness_cache is not None:
+                    key = FitnessCache.genom_key(individual.genom)
+                    fitness = self.fitness_cache.get(key)
+                    if fitness is not None:
+                        finished.put((individual, None, (fitness, False), None))
+                        in_flight += 1
+                        continue
+                cutoff = survivors[0][0] if len(survivors) >= num_survivors else None
+                self.evaluations += 1
+                if self.pool is not None:
+                    self.pool.apply_async(_evaluate_batch, ([(individual.genom, cutoff)],),
+                                          callback=lambda output, i=individual, k=key: finished.put((i, k, output[0][0], output[1])),
+                                          error_callback=finished.put)
+                else:
+                    finished.put((individual, key, self.evaluate(individual.genom, cutoff), None))
+                in_flight += 1
+            result = finished.get()
+            if isinstance(result, BaseException):
+                raise result
+            in_flight -= 1
+            individual, key, (fitness, estimated), counters = result
+            if counters is not None:
+                self.worker_counters.update(counters)
+            individual.fitness, individual.estimated = fitness, estimated
+            if key is not None and not individual.estimated:
+                self.fitness_cache.put(key, individual.fitness)
+            evaluated.append(individual)
+            entry = (individual.fitness, next(sequence), individual)
+            if len(survivors) < num_survivors:
+                heapq.heappush(survivors, entry)
+            else:
+                heapq.heappushpop(survivors, entry)
+            if len(evaluated) < round_size or len(survivors) < num_survivors:
+                continue
+            self.generation += 1
+            ranked = [s[2] for s in sorted(survivors, key=lambda s: s[0], reverse=True)]
+            if MEMETIC_ELITE > 0:
+                ranked = self.local_search(ranked)
+                survivors = [(ind.fitness, next(sequence), ind) for ind in ranked]
+                heapq.heapify(survivors)
+            self.winner = ranked[0].genom
+            self.winner_fitness = ranked[0].getFitness()
+            # survivors evaluated in this round are in both lists, count them once
+            survivor_ids = {id(ind) for ind in ranked}
+            self.log_stats(ranked + [ind for ind in evaluated if id(ind) not in survivor_ids], start_time, ranked)
+            evaluated = []
+            start_time = time()
+            if self.generation >= TOURNAMENT_SIZE:
+                return
+            # same adaptation as evolve(), but without the alternative breed (a generational phase)
+            if self.worst_survivor_fitness == ranked[-1].getFitness():
+                self.stagnation_count += 1
+                self.mutation_rate = self.mutation_rate * 1.05
+                if self.stagnation_count >= 10:
+                    print(f"Warn: Termininating after #{self.stagnation_count} stagnations")
                     return
             else:
-                worst_survivor_fitness = survivors[-1].getFitness()
+                self.worst_survivor_fitness = ranked[-1].getFitness()
+            if self.island is not None:
+                immigrants = self.migrate(ranked)
+                if immigrants is not ranked:
+                    survivors = [(ind.fitness, next(sequence), ind) for ind in immigrants]
+                    heapq.heapify(survivors)
+            if CHECKPOINT and self.generation - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+                with timers("checkpoint"):
+                    self.save_checkpoint(ranked)
+
+
+    def local_search(self, survivors):
+        """
+        improve the best MEMETIC_ELITE survivors in place (see climb()), in parallel
+        with WORKERS, return the survivors sorted by fitness again
+        """
+        elite = [individual for individual in survivors[:MEMETIC_ELITE] if not individual.estimated]
+        with timers("local_search"):
+            if self.pool is not None:
+                results = self.pool.map(_climb, [(individual.genom, individual.fitness) for individual in elite])
+            else:
+                results = [self.climb(individual.genom, individual.fitness) for individual in elite]
+        gain = 0.0
+        evaluations = 0
+        for individual, (genom, fitness, count) in zip(elite, results):
+            evaluations += count
+            if fitness > individual.fitness:
+                gain += fitness - individual.fitness
+                individual.genom, individual.fitness = genom, fitness
+        self.evaluations += evaluations
+        self.local_search_gain += gain
+        self.local_search_evaluations += evaluations
+        if evaluations:
+            print(f"Info: Local search: +{gain:.5f} fitness in {evaluations} evaluations "
+                  f"({gain / evaluations:.2e} per evaluation)")
+        survivors.sort(key=lambda x: x.getFitness(), reverse=True)
+        return survivors
+
+
+    def climb(self, genom, fitness):
+        """
+        local search from the genom with MEMETIC_BUDGET evaluations of single gene mutations:
+        hill climbing, or simulated annealing with the temperature cooling down linearly
+        from MEMETIC_TEMPERATURE. return the best genom, its fitness and the number of evaluations
+        """
+        current = Individual(genom)
+        current.fitness = fitness
+        best = current
+        evaluations = 0
+        for step in range(MEMETIC_BUDGET):
+            temperature = MEMETIC_TEMPERATURE * (1 - step / MEMETIC_BUDGET)
+            candidate = current.copy()
+            candidate.mutate()
+            key = None
+            if self.fitness_cache is not None:
+                key = FitnessCache.genom_key(candidate.genom)
+                candidate.fitness = self.fitness_cache.get(key)
+            if candidate.fitness is None:
+                # hill climbing only needs to know whether the mutation is better (early exit)
+                candidate.fitness, estimated = self.evaluate(candidate.genom, None if temperature > 0 else current.fitness)
+                evaluations += 1
+                if estimated:
+                    continue
+                if key is not None:
+                    self.fitness_cache.put(key, candidate.fitness)
+            delta = candidate.fitness - current.fitness
+            if delta > 0 or (temperature > 0 and random() < exp(delta / temperature)):
+                current = candidate
+                if current.fitness > best.fitness:
+                    best = current
+        return best.genom, best.fitness, evaluations
+
+
+    def checkpoint_path(self):
+        if self.island is None:
+            return CHECKPOINT
+        base, extension = os.path.splitext(CHECKPOINT)
+        return f"{base}.island{self.island[0]}{extension}"
+
+
+    def save_checkpoint(self, population):
+        """
+        save the population (with fitness), the fitness cache and the state of the run,
+        the file is written in the background to not stall the generation loop
+        """
+        self.last_checkpoint = self.generation
+        state = {
+            "generation": self.generation,
+            "mutation_rate": self.mutation_rate,
+            "worst_survivor_fitness": self.worst_survivor_fitness,
+            "stagnation_count": self.stagnation_count,
+            "last_migration": self.last_migration,
+            "random": getstate(),
+            "numpy_random": Population.rng.bit_generator.state,
+        }
+        arrays = {
+            "genoms": Population.from_individuals(population).genes,
+            "fitness": np.array([np.nan if ind.fitness is None else ind.fitness for ind in population]),
+            "estimated": np.array([ind.estimated for ind in population]),
+            "state": np.frombuffer(json.dumps(state).encode(), dtype=np.uint8),
+        }
+        if self.fitness_cache is not None:
+            arrays["cache_keys"], arrays["cache_fitness"] = self.fitness_cache.export()
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.join()
+        self.checkpoint_writer = threading.Thread(target=Genetics._write_checkpoint,
+                                                  args=(self.checkpoint_path(), arrays))
+        self.checkpoint_writer.start()
+
+
+    @staticmethod
+    def _write_checkpoint(path, arrays):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+
+    def load_checkpoint(self):
+        """
+        restore the state of the run from the checkpoint, return the population
+        """
+        with np.load(self.checkpoint_path()) as checkpoint:
+            state = json.loads(checkpoint["state"].tobytes())
+            genes = checkpoint["genoms"]
+            fitness = checkpoint["fitness"]
+            estimated = checkpoint["estimated"]
+            if self.fitness_cache is not None and "cache_keys" in checkpoint:
+                self.fitness_cache.restore(checkpoint["cache_keys"], checkpoint["cache_fitness"])
+        if ARRAY_POPULATION:
+            population = Population(genes).individuals()
+        else:
+            population = [Individual([tuple(gene) for gene in genom]) for genom in genes.tolist()]
+        for individual, value, flag in zip(population, fitness, estimated):
+            individual.fitness = None if np.isnan(value) else float(value)
+            individual.estimated = bool(flag)
+        self.generation = state["generation"]
+        self.mutation_rate = state["mutation_rate"]
+        self.worst_survivor_fitness = state["worst_survivor_fitness"]
+        self.stagnation_count = state["stagnation_count"]
+        self.last_migration = state["last_migration"]
+        self.last_checkpoint = self.generation
+        version, internal, gauss = state["random"]
+        setstate((version, tuple(internal), gauss))
+        Population.rng.bit_generator.state = state["numpy_random"]
+        print(f"Info: Resuming from generation {self.generation + 1} ({self.checkpoint_path()})")
+        return population
+
+
+    def reproduce(self, survivors):
+        """
+        return the next generation: children of the survivors (some of them mutated) and the survivors
+        """
+        population = []
+        count = SIZE_OF_GENERATION - len(survivors)
+        if ARRAY_POPULATION and count > 0:
+            with timers("breed"):
+                children = Population.breed(Population.from_individuals(survivors), count)
+            with timers("mutate"):
+                children.mutate(Population.rng.integers(0, count, int(count * self.mutation_rate)))
+                population = children.individuals()
+        else:
             # Breeding
-            while len(population) + len(survivors) < SIZE_OF_GENERATION:
-                child = Individual.breed(sample(survivors, MAX_PARENTS))
-                population.append(child)
+            with timers("breed"):
+                while len(population) + len(survivors) < SIZE_OF_GENERATION:
+                    child = Individual.breed(sample(survivors, MAX_PARENTS))
+                    population.append(child)
             # Mutation
-            for _ in range(int(len(population) * self.mutation_rate)):
-                individual = population[randint(0,  len(population) - 1)]
-                individual.mutate()
-            # Elitism: carry over the best individuals
-            population += survivors
+            with timers("mutate"):
+                for _ in range(int(len(population) * self.mutation_rate)):
+                    individual = population[randint(0,  len(population) - 1)]
+                    individual.mutate()
+        # Elitism: carry over the best individuals
+        return population + survivors
+
+
+    def migrate(self, survivors):
+        """
+        send the best survivors to the neighbour islands (every MIGRATION_INTERVAL
+        generations), received immigrants replace the worst survivors
+        """
+        index, queues = self.island
+        if self.generation - self.last_migration >= MIGRATION_INTERVAL:
+            self.last_migration = self.generation
+            others = [i for i in range(len(queues)) if i != index]
+            if not others:
+                targets = []
+            elif MIGRATION_TOPOLOGY == "ring":
+                targets = [(index + 1) % len(queues)]
+            elif MIGRATION_TOPOLOGY == "all":
+                targets = others
+            else:
+                targets = [choice(others)]
+            emigrants = [(ind.genom, ind.getFitness()) for ind in survivors[:MIGRANTS]]
+            for target in targets:
+                queues[target].put(emigrants)
+        # islands run at different speeds, so only take what has arrived yet
+        immigrants = []
+        while True:
+            try:
+                immigrants += queues[index].get_nowait()
+            except queue.Empty:
+                break
+        if not immigrants:
+            return survivors
+        immigrants = immigrants[:len(survivors) // 2]
+        print(f"Info: Island {index} received {len(immigrants)} immigrants")
+        for genom, fitness in immigrants:
+            individual = Individual(genom)
+            individual.fitness = fitness
+            survivors.append(individual)
+        survivors.sort(key=lambda x: x.getFitness(), reverse=True)
+        return survivors[:len(survivors) - len(immigrants)]
+
 
+    def run_islands(self):
+        """
+        run ISLANDS populations in parallel processes, the best winner of all islands wins
+        """
+        if MASK_STORE:
+            MaskStore.load(self.target_images, MASK_STORE)  # compile once, not on every island
+        # islands do not start worker pools of their own
+        settings = {name: value for name, value in globals().items() if name.isupper()}
+        settings["WORKERS"] = 0
+        context = multiprocessing.get_context("spawn")
+        queues = [context.Queue() for _ in range(ISLANDS)]
+        results = context.Queue()
+        islands = [context.Process(target=_run_island, args=(i, self.target_images, settings, queues, results))
+                   for i in range(ISLANDS)]
+        for island in islands:
+            island.start()
+        try:
+            pending = set(range(ISLANDS))
+            while pending:
+                try:
+                    index, winner, winner_fitness, error = results.get(timeout=1.0)
+                except queue.Empty:
+                    # an island always reports, unless its process died (e.g. killed or crashed)
+                    for i in pending:
+                        if islands[i].exitcode is not None and islands[i].exitcode != 0:
+                            raise RuntimeError(f"Error: Island {i} died with exit code {islands[i].exitcode}.")
+                    continue
+                pending.discard(index)
+                if error is not None:
+                    raise RuntimeError(f"Error: Island {index} failed:\n{error}")
+                print(f"Info: Island {index} finished with fitness {winner_fitness}")
+                if winner is not None and (self.winner_fitness is None or winner_fitness > self.winner_fitness):
+                    self.winner, self.winner_fitness = winner, winner_fitness
+        finally:
+            for island in islands:
+                island.terminate()
 
-    def alternative_breed(self, fitness_function, target_fitness, population=[]):
+
+    def alternative_breed(self, target_fitness, population=[]):
         # additional breeding to reach target fitness
         population += self.create_random_population(SIZE_OF_GENERATION - len(population))
         last_worst_fitness = -1000.0
         while True:
             self.generation += 1
             start_time = time()
-            population.sort(key=lambda x: x.getFitness(fitness_function=fitness_function), reverse=True)
+            self.evaluate_population(population)
+            population.sort(key=lambda x: x.getFitness(), reverse=True)
             num_survivors = int(SIZE_OF_GENERATION * SURVIVOR_RATE)
             survivors = population[:num_survivors]
             self.log_stats(population, start_time, survivors)
@@ -239,39 +1078,134 @@ class Genetics:
                 print("Info: Ending alternative breeding phase.")
                 return survivors
             last_worst_fitness = survivors[-1].getFitness()
-            # Breeding
-            while len(population) + len(survivors) < SIZE_OF_GENERATION:
-                child = Individual.breed(sample(survivors, MAX_PARENTS))
-                population.append(child)
-            # Mutation
-            for _ in range(int(len(population) * self.mutation_rate)):
-                individual = population[randint(0,  len(population) - 1)]
-                individual.mutate()
-            # Elitism: carry over the best individuals
-            population += survivors
+            population = self.reproduce(survivors)
 
 
     def log_stats(self, population, start_time, survivors):
         if self.generation % 25 == 0:
             print( "=============================================================")
-            print("           best     worst   average   average")
-            print("    #  survivor  survivor survivors       all  duration")
-            #      ----+----|----+----|----+----|----+----|----+----|----+----|
-        print(f"{self.generation:5d}"+
-                  f"{survivors[0].getFitness():10.5f}"+
-                  f"{survivors[-1].getFitness():10.5f}"+
-                  f"{sum(ind.getFitness() for ind in survivors) / len(survivors):10.5f}"+
-                  f"{sum(ind.getFitness() for ind in population) / len(population):10.5f}"+
-                  f"{time() - start_time:10.3f}")
+            print("           best     worst   average   average                       cache  cascade")
+            print("    #  survivor  survivor survivors       all  duration  evals/s     hits    saved")
+            #      ----+----|----+----|----+----|----+----|----+----|----+----|----+----|----+----|----+----|
+            if self.counters()["coarse_evaluations"]:
+                print(f"Info: {CascadeEvaluator.summary(self.counters())}")
+            if self.surrogate is not None:
+                print(f"Info: {self.surrogate}")
+        cache_hits = ""
+        if self.fitness_cache is not None:
+            cache_hits = f"{self.fitness_cache.hit_rate() * 100:8.1f}%"
+            self.fitness_cache.flush()
+        cascade_saved = ""
+        if self.counters()["coarse_evaluations"]:
+            cascade_saved = f"{CascadeEvaluator.saved(self.counters()) * 100:8.1f}%"
+        duration = time() - start_time
+        evaluations_per_second = (self.evaluations - self.logged_evaluations) / duration if duration > 0 else 0.0
+        self.logged_evaluations = self.evaluations
+        # survivors are the first of the population (sorted by fitness)
+        fitness = np.fromiter((ind.getFitness() for ind in population), dtype=np.float64, count=len(population))
+        survivor_fitness = np.fromiter((ind.getFitness() for ind in survivors), dtype=np.float64, count=len(survivors))
+        if self.telemetry is not None:
+            self.telemetry.write({
+                "generation": self.generation,
+                "island": None if self.island is None else self.island[0],
+                "time": round(time(), 3),
+                "duration": round(duration, 6),
+                "evaluations": self.evaluations,
+                "evaluations_per_second": round(evaluations_per_second, 2),
+                "best": float(survivor_fitness[0]),
+                "worst_survivor": float(survivor_fitness[-1]),
+                "average_survivors": float(survivor_fitness.mean()),
+                "average_all": float(fitness.mean()),
+                "cache_hit_rate": None if self.fitness_cache is None else round(self.fitness_cache.hit_rate(), 4),
+                "max_rss_mb": max_rss_mb(),
+                "stages": timers.reset(),  # since the last record (breeding is done after logging)
+            })
+        print(("" if self.island is None else f"[{self.island[0]}]")+
+                  f"{self.generation:5d}"+
+                  f"{survivor_fitness[0]:10.5f}"+
+                  f"{survivor_fitness[-1]:10.5f}"+
+                  f"{survivor_fitness.mean():10.5f}"+
+                  f"{fitness.mean():10.5f}"+
+                  f"{duration:10.3f}"+
+                  f"{evaluations_per_second:9.1f}"+
+                  cache_hits+
+                  cascade_saved)
 
 
     def create_random_population(self, count):
+        if ARRAY_POPULATION:
+            return Population.random(count, SIZE_OF_GENOM).individuals()
         population = []
         for _ in range(count):
             population.append(Individual.random_individual(SIZE_OF_GENOM))
         return population
 
 
+_worker_genetics = None
+
+
+def _init_worker(target_images, settings):
+    global _worker_genetics, _worker_counters
+    globals().update(settings)
+    app = None
+    if FITNESS_BACKEND == "panda":
+        app = visualization.headless_app(callback=lambda app: None, prc_file="headless_128x128.prc")
+    _worker_genetics = Genetics(target_images)
+    _worker_genetics.setup_evaluation(app)
+    _worker_counters = Counter()  # counters already reported to the main process
+
+
+def _evaluate_batch(batch):
+    """
+    return the results of the batch and the counters of this worker since its last batch
+    (see Genetics.counters()), the main process adds them up
+    """
+    global _worker_counters
+    results = [_worker_genetics.evaluate(genom, cutoff) for genom, cutoff in batch]
+    counters = _worker_genetics.counters()
+    reported, _worker_counters = _worker_counters, counters
+    return results, dict(counters - reported)
+
+
+def _climb(arguments):
+    return _worker_genetics.climb(*arguments)
+
+
+def _run_island(index, target_images, settings, queues, results):
+    globals().update(settings)
+    for q in queues:
+        q.cancel_join_thread()  # do not wait for unread migrants at exit
+    genetics = None
+    error = None
+    try:
+        genetics = Genetics(target_images)
+        genetics.island = (index, queues)
+        if FITNESS_BACKEND in ("raster", "incremental"):
+            genetics.run()
+        else:
+            visualization.headless_app(callback=genetics.run, prc_file="headless_128x128.prc")
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        # the parent waits for a result of every island, also if this one failed
+        if genetics is None or error is not None:
+            results.put((index, None, None, error))
+        else:
+            results.put((index, genetics.winner, genetics.winner_fitness, None))
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if value.strip().lower() in ("1", "true", "yes", "on"):
+        return True
+    if value.strip().lower() in ("0", "false", "no", "off"):
+        return False
+    raise ValueError(f"invalid boolean value '{value}'")
+
+
 def _get_from_env(var_name, default, cast_type):
     value = os.getenv(var_name)
     if value is None:
@@ -290,7 +1224,13 @@ def load_settings():
     global SIZE_OF_GENOM, SIZE_OF_GENERATION, SURVIVOR_RATE, MUTATION_RATE
     global TOURNAMENT_SIZE, FITNESS_IMAGE_PATH, FITNESS_IMAGES
     global CAMERA_DISTANCE, QUANTIZATION, RADIUS, MIN_SCALE, MAX_SCALE
-    global FITNESS_FUNCTION_FACTOR, Q
+    global FITNESS_FUNCTION_FACTOR, Q, TILED_RENDERING, FITNESS_BACKEND, FOOTPRINT_CACHE_MB
+    global FITNESS_CACHE_SIZE, FITNESS_CACHE_DIR, CASCADE_EVALUATION, EARLY_EXIT
+    global MASK_STORE, WORKERS, ISLANDS, MIGRATION_INTERVAL, MIGRANTS, MIGRATION_TOPOLOGY
+    global ARRAY_POPULATION, CHECKPOINT, CHECKPOINT_INTERVAL, STEADY_STATE
+    global SURROGATE, SURROGATE_KEEP, SURROGATE_MIN_CORRELATION
+    global MEMETIC_ELITE, MEMETIC_BUDGET, MEMETIC_TEMPERATURE, TELEMETRY, PIPELINE_THREADS, PIPELINE_QUEUE
+    global ORDER_EVALUATIONS, ATLAS_RENDERING
     SIZE_OF_GENOM = _get_from_env("SIZE_OF_GENOM", SIZE_OF_GENOM, int)
     SIZE_OF_GENERATION = _get_from_env("SIZE_OF_GENERATION", SIZE_OF_GENERATION, int)
     SURVIVOR_RATE = _get_from_env("SURVIVOR_RATE", SURVIVOR_RATE, float)
@@ -304,6 +1244,34 @@ def load_settings():
     MIN_SCALE = _get_from_env("MIN_SCALE", MIN_SCALE, int)
     MAX_SCALE = _get_from_env("MAX_SCALE", MAX_SCALE, int)
     FITNESS_FUNCTION_FACTOR = _get_from_env("FITNESS_FUNCTION_FACTOR", FITNESS_FUNCTION_FACTOR, float)
+    TILED_RENDERING = _get_from_env("TILED_RENDERING", TILED_RENDERING, _to_bool)
+    ATLAS_RENDERING = _get_from_env("ATLAS_RENDERING", ATLAS_RENDERING, _to_bool)
+    FITNESS_BACKEND = _get_from_env("FITNESS_BACKEND", FITNESS_BACKEND, str)
+    FOOTPRINT_CACHE_MB = _get_from_env("FOOTPRINT_CACHE_MB", FOOTPRINT_CACHE_MB, int)
+    FITNESS_CACHE_SIZE = _get_from_env("FITNESS_CACHE_SIZE", FITNESS_CACHE_SIZE, int)
+    FITNESS_CACHE_DIR = _get_from_env("FITNESS_CACHE_DIR", FITNESS_CACHE_DIR, str)
+    CASCADE_EVALUATION = _get_from_env("CASCADE_EVALUATION", CASCADE_EVALUATION, _to_bool)
+    EARLY_EXIT = _get_from_env("EARLY_EXIT", EARLY_EXIT, _to_bool)
+    MASK_STORE = _get_from_env("MASK_STORE", MASK_STORE, str)
+    WORKERS = _get_from_env("WORKERS", WORKERS, int)
+    ISLANDS = _get_from_env("ISLANDS", ISLANDS, int)
+    MIGRATION_INTERVAL = _get_from_env("MIGRATION_INTERVAL", MIGRATION_INTERVAL, int)
+    MIGRANTS = _get_from_env("MIGRANTS", MIGRANTS, int)
+    MIGRATION_TOPOLOGY = _get_from_env("MIGRATION_TOPOLOGY", MIGRATION_TOPOLOGY, str)
+    ARRAY_POPULATION = _get_from_env("ARRAY_POPULATION", ARRAY_POPULATION, _to_bool)
+    CHECKPOINT = _get_from_env("CHECKPOINT", CHECKPOINT, str)
+    CHECKPOINT_INTERVAL = _get_from_env("CHECKPOINT_INTERVAL", CHECKPOINT_INTERVAL, int)
+    STEADY_STATE = _get_from_env("STEADY_STATE", STEADY_STATE, _to_bool)
+    SURROGATE = _get_from_env("SURROGATE", SURROGATE, _to_bool)
+    SURROGATE_KEEP = _get_from_env("SURROGATE_KEEP", SURROGATE_KEEP, float)
+    SURROGATE_MIN_CORRELATION = _get_from_env("SURROGATE_MIN_CORRELATION", SURROGATE_MIN_CORRELATION, float)
+    MEMETIC_ELITE = _get_from_env("MEMETIC_ELITE", MEMETIC_ELITE, int)
+    MEMETIC_BUDGET = _get_from_env("MEMETIC_BUDGET", MEMETIC_BUDGET, int)
+    MEMETIC_TEMPERATURE = _get_from_env("MEMETIC_TEMPERATURE", MEMETIC_TEMPERATURE, float)
+    TELEMETRY = _get_from_env("TELEMETRY", TELEMETRY, str)
+    PIPELINE_THREADS = _get_from_env("PIPELINE_THREADS", PIPELINE_THREADS, int)
+    PIPELINE_QUEUE = _get_from_env("PIPELINE_QUEUE", PIPELINE_QUEUE, int)
+    ORDER_EVALUATIONS = _get_from_env("ORDER_EVALUATIONS", ORDER_EVALUATIONS, _to_bool)
     Q = RADIUS // QUANTIZATION
 
 
@@ -313,17 +1281,34 @@ if __name__ == "__main__":
     print("Info: Starting genetic algorithm... (cancel with Ctrl-C)")
     print("=============================================================")
     load_settings()
+    if "--resume" in sys.argv:
+        sys.argv.remove("--resume")
+        RESUME = True
+        assert CHECKPOINT, "Error: --resume needs a CHECKPOINT file to resume from."
     print("=============================================================")
     assert len(FITNESS_IMAGES) > 0, "Error: No FITNESS_IMAGES specified in .env file."
     target_images = [FITNESS_IMAGE_PATH + img for img in FITNESS_IMAGES.split(",")]
     for img in target_images:
         assert os.path.isfile(img), f"Error: Target image file '{img}' does not exist."
+    assert FITNESS_BACKEND in ("panda", "raster", "incremental"), f"Error: Unknown FITNESS_BACKEND '{FITNESS_BACKEND}'."
+    assert PIPELINE_THREADS == 0 or (FITNESS_BACKEND == "panda" and not TILED_RENDERING), \
+        "Error: PIPELINE_THREADS requires the \"panda\" backend without TILED_RENDERING."
+    assert not CASCADE_EVALUATION or not TILED_RENDERING, \
+        "Error: CASCADE_EVALUATION does not support TILED_RENDERING (a tiled frame renders all views)."
+    assert not ATLAS_RENDERING or (FITNESS_BACKEND == "panda" and not TILED_RENDERING), \
+        "Error: ATLAS_RENDERING requires the \"panda\" backend without TILED_RENDERING."
+    assert MIGRATION_TOPOLOGY in ("ring", "all", "random"), f"Error: Unknown MIGRATION_TOPOLOGY '{MIGRATION_TOPOLOGY}'."
     genetics = Genetics(target_images)
     try:
-        visualization.headless_app(callback=genetics.run, prc_file="headless_128x128.prc")
+        if ISLANDS > 0:
+            genetics.run_islands()
+        elif FITNESS_BACKEND in ("raster", "incremental") or WORKERS > 0:
+            genetics.run()
+        else:
+            visualization.headless_app(callback=genetics.run, prc_file="headless_128x128.prc")
     except KeyboardInterrupt:
         print("Info: Interrupted by user.")
-    json_str = json.dumps(genetics.winner, indent=4, check_circular=False)
+    json_str = json.dumps(Population.to_json(genetics.winner), indent=4, check_circular=False)
     filename = "winner.%d.json" % int(time()) if len(sys.argv) < 2 else sys.argv[1]
     with open(filename, "w") as f:
         f.write(json_str)
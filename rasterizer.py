@@ -0,0 +1,448 @@
+from collections import Counter, OrderedDict, namedtuple
+from math import radians, tan
+import numpy as np
+from fitness import FitnessFunction, texture_to_ink
+from telemetry import timers
+from visualization import SIZE_SCALE, load_digits
+
+
+# defaults of the Panda3D lens used by the Visualizer
+FIELD_OF_VIEW = 30.0
+NEAR_DISTANCE = 1.0
+
+
+def load_digit_textures(path="img/"):
+    """
+    return the gray levels and the alpha values of the textures of the front and the
+    back of each digit (see visualization.load_digit()) as float32 arrays of shape
+    (20, height, width), the texture of a digit's side is at index digit * 2 + side,
+    rows are in texture order (bottom up)
+    """
+    gray = []
+    alpha = []
+    for i, digit in enumerate(load_digits(path)):
+        for texture in (digit.getTexture(), digit.find(f"digit {i} back").getTexture()):
+            gray.append(1 - texture_to_ink(texture).reshape(texture.getYSize(), texture.getXSize()))
+            ram = np.frombuffer(texture.getRamImage(), dtype=np.uint8)
+            ram = ram.reshape(texture.getYSize(), texture.getXSize(), texture.getNumComponents())
+            alpha.append(ram[:, :, 3] / np.float32(255.0))
+    return np.stack(gray), np.stack(alpha)
+
+
+class Squares():
+    """
+    The textured squares of a configuration of digits, as arrays (one row per gene).
+    """
+
+    def __init__(self, configuration):
+        genes = np.asarray(configuration, dtype=np.float64).reshape(-1, 6)
+        self.digits = genes[:, 0].astype(np.intp)
+        self.centers = genes[:, 1:4] / SIZE_SCALE
+        scale = genes[:, 4] / SIZE_SCALE
+        heading = np.radians(genes[:, 5])
+        # axes of the digits in scene coordinates: width (x), normal (y) and height (z)
+        self.x_axes = np.stack([np.cos(heading), np.sin(heading), np.zeros_like(heading)], axis=1) * scale[:, None]
+        self.normals = np.stack([-np.sin(heading), np.cos(heading), np.zeros_like(heading)], axis=1)
+        self.z_axes = np.zeros_like(self.centers)
+        self.z_axes[:, 2] = scale
+
+
+class Fragments(namedtuple("Fragments", "pixel gray alpha distance depth square")):
+    """
+    Fragments of rendered squares: pixel index, gray level, alpha, distance to the camera,
+    depth of the square's center (draw order) and index of the square.
+    """
+
+    def select(self, mask):
+        return Fragments(*(values[mask] for values in self))
+
+
+    @staticmethod
+    def concatenate(fragments):
+        return Fragments(*(np.concatenate(values) for values in zip(*fragments)))
+
+
+class FootprintCache():
+    """
+    LRU cache of the fragments of single genes (footprints) keyed by (gene, view, image width),
+    limited by the memory used by the fragments.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key):
+        fragments = self.entries.get(key)
+        if fragments is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return fragments
+
+
+    def put(self, key, fragments):
+        size = sum(values.nbytes for values in fragments)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= sum(values.nbytes for values in self.entries.pop(key))
+        self.entries[key] = fragments
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= sum(values.nbytes for values in evicted)
+            self.evictions += 1
+
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+    def __str__(self):
+        return (f'FootprintCache(entries={len(self.entries)}, size={self.bytes / 2**20:.1f} MB, '
+                f'hits={self.hits}, misses={self.misses}, evictions={self.evictions})')
+
+
+class Rasterizer():
+    """
+    Renders a configuration of digits like the Visualizer does, but on the CPU with NumPy only.
+    Each digit is a textured square (front and back with different textures), the
+    fragments of all digits of a view are blended back to front (alpha blending)
+    on a white background.
+    """
+
+    def __init__(self, image_size, camera_distance, digit_path="img/"):
+        self.width, self.height = image_size
+        self.camera_distance = camera_distance
+        self.texture_gray, self.texture_alpha = load_digit_textures(digit_path)
+        self.tan_x = tan(radians(FIELD_OF_VIEW / 2))
+        self.tan_z = self.tan_x * self.height / self.width
+        self.set_configuration([])
+
+
+    def set_configuration(self, configuration):
+        """
+        Set the configuration, a list of genes [digit, x, y, z, size, heading_degrees].
+        """
+        self.squares = Squares(configuration)
+
+
+    def render(self, degrees, out=None):
+        """
+        Render the scene rotated by the given degrees and return the ink (1 - gray level)
+        of each pixel as flat float32 array, rows are bottom up (see fitness.texture_to_ink())
+        """
+        if out is None:
+            out = np.empty(self.width * self.height, dtype=np.float32)
+        out[:] = self.composite(self.fragments(self.squares, degrees))
+        return out
+
+
+    def fragments(self, squares, degrees):
+        """
+        return the visible fragments of the squares in the scene rotated by the given degrees
+        """
+        # camera space: x to the right, y (depth) into the screen, z up
+        centers = self._rotate(squares.centers, degrees)
+        centers[:, 1] -= self.camera_distance
+        x_axes = self._rotate(squares.x_axes, degrees)
+        normals = self._rotate(squares.normals, degrees)
+        z_axes = squares.z_axes
+
+        # projected bounding box of each square, in pixels
+        corners = (centers[:, None, :]
+                   + np.array([-0.5, 0.5, 0.5, -0.5])[None, :, None] * x_axes[:, None, :]
+                   + np.array([-0.5, -0.5, 0.5, 0.5])[None, :, None] * z_axes[:, None, :])
+        depth = corners[:, :, 1]
+        visible = (depth > NEAR_DISTANCE).all(axis=1)
+        depth = np.where(visible[:, None], depth, 1.0)
+        screen_x = (corners[:, :, 0] / depth / self.tan_x + 1) * 0.5 * self.width
+        screen_z = (corners[:, :, 2] / depth / self.tan_z + 1) * 0.5 * self.height
+        # pixel centers (i + 0.5) within the bounding box
+        x0 = np.maximum(np.ceil(screen_x.min(axis=1) - 0.5), 0).astype(np.intp)
+        x1 = np.minimum(np.floor(screen_x.max(axis=1) - 0.5), self.width - 1).astype(np.intp)
+        z0 = np.maximum(np.ceil(screen_z.min(axis=1) - 0.5), 0).astype(np.intp)
+        z1 = np.minimum(np.floor(screen_z.max(axis=1) - 0.5), self.height - 1).astype(np.intp)
+        columns = np.where(visible, np.maximum(x1 - x0 + 1, 0), 0)
+        rows = np.maximum(z1 - z0 + 1, 0)
+        counts = columns * rows
+
+        # one fragment per pixel of each bounding box
+        square = np.repeat(np.arange(len(counts)), counts)
+        offset = np.arange(square.size) - np.repeat(np.cumsum(counts) - counts, counts)
+        pixel_x = x0[square] + offset % columns[square]
+        pixel_z = z0[square] + offset // columns[square]
+        rays = np.stack([((pixel_x + 0.5) / self.width * 2 - 1) * self.tan_x,
+                         np.ones(square.size),
+                         ((pixel_z + 0.5) / self.height * 2 - 1) * self.tan_z], axis=1)
+
+        # intersection of the rays with the plane of the squares
+        center = centers[square]
+        normal = normals[square]
+        distance = np.einsum("ij,ij->i", normal, center) / np.einsum("ij,ij->i", normal, rays)
+        relative = rays * distance[:, None] - center
+        x_axis = x_axes[square]
+        z_axis = z_axes[square]
+        u = np.einsum("ij,ij->i", relative, x_axis) / np.einsum("ij,ij->i", x_axis, x_axis)
+        v = np.einsum("ij,ij->i", relative, z_axis) / np.einsum("ij,ij->i", z_axis, z_axis)
+        inside = (np.abs(u) <= 0.5) & (np.abs(v) <= 0.5)
+        # the front is visible if the camera is behind the square's normal,
+        # the back's texture is mirrored (see load_digit())
+        back = (np.einsum("ij,ij->i", normals, centers) <= 0)[square]
+        u = np.where(back, 0.5 - u, u + 0.5)
+        v = v + 0.5
+        texture = squares.digits[square] * 2 + back
+        gray, alpha = self._sample(texture[inside], u[inside], v[inside])
+        square = square[inside]
+        fragments = Fragments(pixel=(pixel_z * self.width + pixel_x)[inside], gray=gray, alpha=alpha,
+                              distance=distance[inside], depth=centers[square, 1], square=square)
+        # fully transparent fragments are discarded (alpha test)
+        return fragments.select(alpha > 0)
+
+
+    def cached_fragments(self, configuration, view, degrees, cache):
+        """
+        return the fragments of the genes of the configuration like fragments() does,
+        the footprint of each gene in the given view is taken from the cache if possible
+        """
+        genes = [tuple(gene) for gene in configuration]
+        footprints = [cache.get((gene, view, self.width)) for gene in genes]
+        missing = [i for i, footprint in enumerate(footprints) if footprint is None]
+        if missing:
+            fragments = self.fragments(Squares([genes[i] for i in missing]), degrees)
+            ends = np.searchsorted(fragments.square, np.arange(1, len(missing) + 1))
+            start = 0
+            for square, i in enumerate(missing):
+                footprint = fragments.select(slice(start, ends[square]))
+                footprint = footprint._replace(square=np.zeros(footprint.pixel.size, dtype=np.intp))
+                cache.put((genes[i], view, self.width), footprint)
+                footprints[i] = footprint
+                start = ends[square]
+        fragments = Fragments.concatenate(footprints) if footprints else self.fragments(Squares([]), degrees)
+        lengths = [footprint.pixel.size for footprint in footprints]
+        return fragments._replace(square=np.repeat(np.arange(len(footprints)), lengths))
+
+
+    def composite(self, fragments):
+        """
+        return the ink per pixel of the blended fragments
+        """
+        # like Panda3D's transparent bin the squares are drawn back to front, sorted by
+        # the depth of their centers, a fragment is only blended if it is nearer than
+        # all fragments drawn before at the same pixel (depth test)
+        order = np.lexsort((-fragments.depth, fragments.pixel))
+        pixel = fragments.pixel[order]
+        gray = fragments.gray[order]
+        alpha = fragments.alpha[order]
+        distance = fragments.distance[order]
+        first = np.ones(pixel.size, dtype=bool)
+        first[1:] = pixel[1:] != pixel[:-1]
+        group = np.cumsum(first) - 1
+        # running minimum of the distance per pixel, the offset separates the pixels
+        offset = group * 1e6
+        nearest = np.minimum.accumulate(distance - offset) + offset
+        drawn_before = np.full(pixel.size, np.inf)
+        drawn_before[1:] = nearest[:-1] + (offset[1:] - offset[:-1])
+        drawn_before[first] = np.inf
+        passed = distance < drawn_before
+
+        # alpha blending: the ink of a fragment is reduced by the transparency of
+        # all fragments blended after it
+        transparency = np.where(passed, np.log(np.maximum(1.0 - alpha, 1e-12)), 0.0)
+        blended = np.cumsum(transparency)
+        blended -= (blended - transparency)[first][group]
+        after = np.bincount(group, weights=transparency)[group] - blended
+        ink = np.where(passed, (1.0 - gray) * alpha * np.exp(after), 0.0)
+        return np.bincount(pixel, weights=ink, minlength=self.width * self.height)
+
+
+    def _rotate(self, vectors, degrees):
+        """rotate vectors around the z axis (heading) like NodePath.setH()"""
+        c = np.cos(np.radians(degrees))
+        s = np.sin(np.radians(degrees))
+        rotated = vectors.copy()
+        rotated[:, 0] = vectors[:, 0] * c - vectors[:, 1] * s
+        rotated[:, 1] = vectors[:, 0] * s + vectors[:, 1] * c
+        return rotated
+
+
+    def _sample(self, texture, u, v):
+        """bilinear texture lookup (clamped), returns gray levels and alpha values"""
+        _, height, width = self.texture_alpha.shape
+        x = u * width - 0.5
+        y = v * height - 0.5
+        left = np.floor(x)
+        bottom = np.floor(y)
+        fx = x - left
+        fy = y - bottom
+        x0 = np.clip(left.astype(np.intp), 0, width - 1)
+        x1 = np.clip(left.astype(np.intp) + 1, 0, width - 1)
+        y0 = np.clip(bottom.astype(np.intp), 0, height - 1)
+        y1 = np.clip(bottom.astype(np.intp) + 1, 0, height - 1)
+        result = []
+        for channel in (self.texture_gray, self.texture_alpha):
+            lower = channel[texture, y0, x0] * (1 - fx) + channel[texture, y0, x1] * fx
+            upper = channel[texture, y1, x0] * (1 - fx) + channel[texture, y1, x1] * fx
+            result.append(lower * (1 - fy) + upper * fy)
+        return result
+
+
+class RasterFitnessFunction(FitnessFunction):
+    """
+    Same fitness as FitnessFunction, but the views are rendered by the Rasterizer,
+    so neither a Visualizer (ShowBase) nor an OpenGL context is needed.
+    """
+
+    def __init__(self, mask_image_paths, fitness_function_factor=1.0, camera_distance=-60, cache=None,
+                 mask_store=None):
+        super().__init__(None, mask_image_paths, fitness_function_factor, mask_store=mask_store)
+        width, height = self.image_size
+        self.rasterizer = Rasterizer((width, height), camera_distance)
+        self.cache = cache
+        # half resolution for the coarse stage of cascade evaluations, the masks are
+        # summed over 2x2 pixels so that the scores keep their range
+        self.coarse_rasterizer = Rasterizer((width // 2, height // 2), camera_distance)
+        self.coarse_target = self.mask_level("target", 1)
+        self.coarse_background = self.mask_level("background", 1)
+        self.coarse_ink = np.empty(self.coarse_target.shape, dtype=np.float32)
+
+
+    def fitness_function(self, configuration, threshold=None):
+        return self._vectorized_fitness_function(configuration, threshold)
+
+
+    def set_configuration(self, configuration):
+        self.configuration = configuration
+
+
+    def render_view(self, i):
+        fragments = self.fragments(self.configuration, i)
+        with timers("composite"):
+            self.ink[i] = self.rasterizer.composite(fragments)
+
+
+    def coarse_fitness(self, configuration):
+        """
+        return an estimate of the fitness from all views rendered at half the resolution
+        (first stage of a cascade evaluation), refine_fitness() renders the full views
+        """
+        self.set_configuration(configuration)
+        for i in range(self.view_count):
+            fragments = self.fragments(configuration, i, self.coarse_rasterizer)
+            with timers("composite"):
+                self.coarse_ink[i] = self.coarse_rasterizer.composite(fragments)
+        self.rendered_views = set()
+        return float(self.score_views(self.coarse_ink, target=self.coarse_target,
+                                      background=self.coarse_background).mean())
+
+
+    def fragments(self, configuration, view, rasterizer=None):
+        """return the fragments of the configuration in the given view (using the cache if any)"""
+        rasterizer = self.rasterizer if rasterizer is None else rasterizer
+        with timers("rasterize"):
+            if self.cache is not None:
+                return rasterizer.cached_fragments(configuration, view, self.positions[view], self.cache)
+            return rasterizer.fragments(Squares(configuration), self.positions[view])
+
+
+class IncrementalFitnessFunction(RasterFitnessFunction):
+    """
+    Same fitness as RasterFitnessFunction, but the fragments of the last evaluated
+    configuration are kept per view together with the ink of each view (coverage buffer).
+    A configuration is evaluated by removing the fragments of the genes no longer
+    present and adding the fragments of the new genes, only the pixels covered
+    by the changed genes are blended again.
+    The order of the genes does not matter, so children mostly made of the genes
+    of the last evaluated configuration are cheap to evaluate.
+    """
+
+    exact_coarse_fitness = True
+
+    def __init__(self, mask_image_paths, fitness_function_factor=1.0, camera_distance=-60, cache=None,
+                 mask_store=None, max_changes=0.5):
+        super().__init__(mask_image_paths, fitness_function_factor, camera_distance, cache, mask_store)
+        # rebuild everything if more than this rate of the genes changed
+        self.max_changes = max_changes
+        self.slots = {}  # gene -> ids of the squares showing this gene
+        self.next_slot = 0
+        self.view_fragments = None
+        self.evaluations = 0
+        self.full_evaluations = 0
+        self.changed_genes = 0
+
+
+    def fitness_function(self, configuration, threshold=None):
+        # all views are updated at once, the threshold is not used
+        counts = Counter(tuple(gene) for gene in configuration)
+        removed = []
+        for gene, slots in self.slots.items():
+            surplus = len(slots) - counts.get(gene, 0)
+            if surplus > 0:
+                removed += [(gene, slot) for slot in slots[-surplus:]]
+        added = []
+        for gene, count in counts.items():
+            added += [gene] * (count - len(self.slots.get(gene, ())))
+        self.evaluations += 1
+        if self.view_fragments is None or len(removed) + len(added) > self.max_changes * len(configuration):
+            self._render(configuration)
+        else:
+            self._update(removed, added)
+        return float(self.score_views(self.ink).mean())
+
+
+    def coarse_fitness(self, configuration):
+        # updating the coverage buffers is cheaper than a coarse rendering, so the
+        # coarse stage is the exact fitness here
+        return self.fitness_function(configuration)
+
+
+    def refine_fitness(self, threshold=None):
+        return float(self.score_views(self.ink).mean())
+
+
+    def _render(self, configuration):
+        self.full_evaluations += 1
+        self.slots = {}
+        for slot, gene in enumerate(configuration):
+            self.slots.setdefault(tuple(gene), []).append(slot)
+        self.next_slot = len(configuration)
+        self.view_fragments = [self.fragments(configuration, i) for i in range(len(self.positions))]
+        with timers("composite"):
+            for i, fragments in enumerate(self.view_fragments):
+                self.ink[i] = self.rasterizer.composite(fragments)
+
+
+    def _update(self, removed, added):
+        self.changed_genes += len(removed) + len(added)
+        for gene, slot in removed:
+            self.slots[gene].remove(slot)
+            if not self.slots[gene]:
+                del self.slots[gene]
+        new_slots = np.arange(self.next_slot, self.next_slot + len(added))
+        self.next_slot += len(added)
+        for gene, slot in zip(added, new_slots):
+            self.slots.setdefault(gene, []).append(int(slot))
+        removed = np.array([slot for _, slot in removed], dtype=np.intp)
+        touched = np.zeros(self.rasterizer.width * self.rasterizer.height, dtype=bool)
+        for i in range(len(self.positions)):
+            old = self.view_fragments[i]
+            gone = np.isin(old.square, removed)
+            new = self.fragments(added, i)
+            new = new._replace(square=new_slots[new.square])
+            touched[:] = False
+            touched[old.pixel[gone]] = True
+            touched[new.pixel] = True
+            fragments = Fragments.concatenate([old.select(~gone), new])
+            with timers("composite"):
+                ink = self.rasterizer.composite(fragments.select(touched[fragments.pixel]))
+            self.ink[i][touched] = ink[touched]
+            self.view_fragments[i] = fragments
+
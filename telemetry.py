@@ -0,0 +1,103 @@
+from collections import defaultdict
+from contextlib import nullcontext
+from time import perf_counter
+import json
+import sys
+import threading
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# a disabled timer is this shared context, which does nothing
+_DISABLED = nullcontext()
+
+
+class StageTimers():
+    """
+    Wall clock time and number of calls per stage of the GA loop (e.g. "render_frame"),
+    accumulated until reset(). Usage: with timers("stage"): ...
+    While disabled (the default) a stage costs one call returning a shared empty context.
+    Stages may be timed from several threads (e.g. the PipelinedEvaluator).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+
+
+    def __call__(self, stage):
+        if not self.enabled:
+            return _DISABLED
+        return _StageTimer(self, stage)
+
+
+    def reset(self):
+        """
+        return the stages timed since the last reset as {stage: {"seconds": s, "calls": n}}
+        """
+        with self.lock:
+            stages = {stage: {"seconds": round(seconds, 6), "calls": self.calls[stage]}
+                      for stage, seconds in sorted(self.seconds.items())}
+            self.seconds.clear()
+            self.calls.clear()
+        return stages
+
+
+class _StageTimer():
+    __slots__ = ("timers", "stage", "start")
+
+    def __init__(self, timers, stage):
+        self.timers = timers
+        self.stage = stage
+
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+
+    def __exit__(self, *exception):
+        seconds = perf_counter() - self.start
+        with self.timers.lock:
+            self.timers.seconds[self.stage] += seconds
+            self.timers.calls[self.stage] += 1
+
+
+# the timers of this process, shared by all modules
+timers = StageTimers()
+
+
+def max_rss_mb():
+    """
+    return the memory high-water mark (maximum resident set size) of this process and
+    of its terminated children in MB, None if not available on this platform
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    unit = 1 if sys.platform == "darwin" else 1024
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(usage * unit / 2**20, 1)
+
+
+class TelemetryLog():
+    """
+    Appends one JSON object per line (JSONL) to a file, e.g. one record per generation.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a", buffering=1)
+
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+
+
+    def close(self):
+        self.file.close()
@@ -1,13 +1,23 @@
 import os
 import sys
+import queue
+import threading
+import multiprocessing
+import copy
 import json
+import time
+import random
+import numpy as np
 import visualization
 import genetics
 import fitness
+import rasterizer
+import telemetry
 
 
 from panda3d.core import PNMImage
 from panda3d.core import Texture
+from panda3d.core import TextureAttrib
 
 
 def load_settings_test():
@@ -108,6 +118,550 @@ def fitness_test(app):
         fitness.DEBUG = False
 
 
+def vectorized_fitness_test(app):
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    config = genetics.Individual.random_individual(220).genom
+    pnm_fitness = fitness.FitnessFunction(app, target_images, vectorized=False).fitness_function(config)
+    numpy_fitness = fitness.FitnessFunction(app, target_images, vectorized=True).fitness_function(config)
+    print("Fitness (PNMImage):", pnm_fitness)
+    print("Fitness (NumPy):   ", numpy_fitness)
+    assert abs(pnm_fitness - numpy_fitness) < 1e-4, "Scoring modes differ"
+
+
+def tiled_fitness_test(app):
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    config = genetics.Individual.random_individual(220).genom
+    views_fitness = fitness.FitnessFunction(app, target_images).fitness_function(config)
+    tiled_fitness = fitness.FitnessFunction(app, target_images, tiled=True).fitness_function(config)
+    app.make_tiled_screenshot().write("tmp/screenshot_tiled.png")
+    print("Fitness (one frame per view):", views_fitness)
+    print("Fitness (tiled):             ", tiled_fitness)
+    assert abs(views_fitness - tiled_fitness) < 1e-3, "Tiled rendering differs"
+    buffer, windows = app.tile_buffer, app.graphicsEngine.getNumWindows()
+    fitness.FitnessFunction(app, target_images, tiled=True)
+    assert app.tile_buffer is buffer, "Tiled buffer not reused"
+    app.setup_tiled_views([0.0, 180.0], (64, 64))
+    app.make_tiled_screenshot()
+    assert app.graphicsEngine.getNumWindows() == windows and len(app.tile_cameras) == 2, "Tiled buffer not replaced"
+
+
+def pipeline_test(app):
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    fitness_function = fitness.FitnessFunction(app, target_images)
+    pipeline = fitness.PipelinedEvaluator(fitness_function, threads=2, queue_size=4)
+    configs = [genetics.Individual.random_individual(220).genom for _ in range(10)]
+    start = time.time()
+    expected = [fitness_function.fitness_function(config) for config in configs]
+    sequential = time.time() - start
+    start = time.time()
+    actual = pipeline.evaluate(configs)
+    pipelined = time.time() - start
+    print(f"Sequential: {sequential:.3f}s, pipelined: {pipelined:.3f}s, {pipeline}")
+    for e, a in zip(expected, actual):
+        assert abs(e - a) < 1e-6, "Pipelined fitness differs"
+
+
+def digit_pool_test(app):
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    fitness_function = fitness.FitnessFunction(app, target_images)
+    large = genetics.Individual.random_individual(220).genom
+    with open("numbers.json", "r") as f:
+        small = json.load(f)
+    expected = fitness_function.fitness_function(large)
+    nodes = app.scene.getNumChildren()
+    fitness_function.fitness_function(small)
+    hidden = sum(digit.isHidden() for digit in app.digit_nodes)
+    actual = fitness_function.fitness_function(large)
+    print(f"Fitness: {expected:.6f}, (after reusing the nodes): {actual:.6f}, hidden nodes: {hidden}")
+    assert hidden == len(large) - len(small), "Unused nodes not hidden"
+    assert app.scene.getNumChildren() == nodes, "Scene nodes were not reused"
+    # the nodes are reordered in the scene graph, digits at the same depth are drawn in another order
+    assert abs(expected - actual) < 1e-3, "Fitness differs after reusing the nodes"
+
+
+def scene_diff_test(app):
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    fitness_function = fitness.FitnessFunction(app, target_images)
+    parent = genetics.Individual.random_individual(220).genom
+    child = list(parent)
+    child[7] = genetics.Individual.create_random_gene()
+    fitness_function.fitness_function(parent)
+    updates = app.node_updates
+    actual = fitness_function.fitness_function(child)
+    print(f"Node updates for one changed gene: {app.node_updates - updates}")
+    assert app.node_updates - updates == 1, "More nodes updated than genes changed"
+    assert len(app.config) == len(child), "Wrong number of nodes shown"
+    app.set_configuration([])
+    expected = fitness_function.fitness_function(child)
+    print(f"Fitness: {expected:.6f}, (diffed scene): {actual:.6f}")
+    assert abs(expected - actual) < 1e-3, "Diffed scene differs from a new scene"
+    parents = [genetics.Individual.random_individual(220) for _ in range(4)]
+    children = [genetics.Individual(list(parent.genom)) for parent in parents]
+    for child in children:
+        child.mutate(5)
+    genoms = [individual.genom for individual in parents + children]
+    order = genetics.Population.similarity_order(genoms)
+    print(f"Order: {order}")
+    assert sorted(order) == list(range(len(genoms))), "Order is no permutation"
+    assert order[1] == 4, "Most similar genom is not next"
+    order = genetics.Population.similarity_order(genoms + [parents[0].genom], neighbours=1)
+    assert sorted(order) == list(range(len(genoms) + 1)), "Order with one neighbour is no permutation"
+
+
+def atlas_test(app):
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    fitness_function = fitness.FitnessFunction(app, target_images)
+    configs = [genetics.Individual.random_individual(220).genom for _ in range(3)]
+    for file in ["numbers.json", "just_one.json", "random.json"]:
+        with open(file, "r") as f:
+            configs.append(json.load(f))
+    expected = [fitness_function.fitness_function(config) for config in configs]
+    app.setup_atlas()
+    for config, value in zip(configs, expected):
+        actual = fitness_function.fitness_function(config)
+        print(f"Fitness (digit nodes): {value:.6f}, (atlas): {actual:.6f}")
+        # digits at the same depth may be blended in another order (see scene_diff_test)
+        assert abs(value - actual) < 1e-3, "Atlas rendering differs from the digit nodes"
+    assert all(digit.isHidden() for digit in app.digit_nodes), "Digit nodes still shown"
+    assert app.atlas.node.node().getNumGeoms() == 1, "Digits are not one geom"
+    stages = app.atlas.node.getState().getAttrib(TextureAttrib).getNumOnStages()
+    assert stages == 1, f"Atlas has {stages} texture stages"
+
+
+def rasterizer_test(app):
+    app.set_camera_distance(genetics.CAMERA_DISTANCE)
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    panda_fitness = fitness.FitnessFunction(app, target_images)
+    raster_fitness = rasterizer.RasterFitnessFunction(target_images, camera_distance=genetics.CAMERA_DISTANCE)
+    configs = [genetics.Individual.random_individual(220).genom for _ in range(5)]
+    for file in ["numbers.json", "just_one.json", "random.json"]:
+        with open(file, "r") as f:
+            configs.append(json.load(f))
+    for config in configs:
+        expected = panda_fitness.fitness_function(config)
+        actual = raster_fitness.fitness_function(config)
+        print(f"Fitness (Panda3D): {expected:.6f}, (rasterizer): {actual:.6f}")
+        assert abs(expected - actual) < 2e-3, "Rasterizer differs from Panda3D"
+    raster_fitness.rasterizer.set_configuration(configs[0])
+    image = PNMImage(128, 128, 1)
+    ink = raster_fitness.rasterizer.render(0).reshape(128, 128)
+    for y in range(128):
+        for x in range(128):
+            image.setGray(x, 127 - y, 1.0 - ink[y, x])
+    image.write("tmp/screenshot_rasterizer.png")
+
+
+def incremental_fitness_test():
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    raster_fitness = rasterizer.RasterFitnessFunction(target_images)
+    incremental_fitness = rasterizer.IncrementalFitnessFunction(target_images)
+    parent = genetics.Individual.random_individual(220)
+    configs = [parent.genom]
+    for count in range(1, 6):
+        configs.append(genetics.Individual(copy.deepcopy(parent.genom)).mutate(count).genom)
+    configs.append(genetics.Individual.random_individual(220).genom)
+    for config in configs:
+        expected = raster_fitness.fitness_function(config)
+        actual = incremental_fitness.fitness_function(config)
+        print(f"Fitness (rasterizer): {expected:.6f}, (incremental): {actual:.6f}")
+        assert abs(expected - actual) < 1e-4, "Incremental fitness differs from rasterizer"
+    print(f"Evaluations: {incremental_fitness.evaluations}, full: {incremental_fitness.full_evaluations}, "
+          f"changed genes: {incremental_fitness.changed_genes}")
+
+
+def footprint_cache_test():
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    raster_fitness = rasterizer.RasterFitnessFunction(target_images)
+    cache = rasterizer.FootprintCache(64 * 2**20)
+    cached_fitness = rasterizer.IncrementalFitnessFunction(target_images, cache=cache)
+    parent = genetics.Individual.random_individual(220)
+    configs = [parent.genom]
+    for count in range(1, 6):
+        configs.append(genetics.Individual(copy.deepcopy(parent.genom)).mutate(count).genom)
+    configs.append(genetics.Individual.breed([parent, genetics.Individual.random_individual(220)]).genom)
+    configs.append(parent.genom)
+    for config in configs:
+        expected = raster_fitness.fitness_function(config)
+        actual = cached_fitness.fitness_function(config)
+        print(f"Fitness (rasterizer): {expected:.6f}, (cached): {actual:.6f}")
+        assert abs(expected - actual) < 1e-4, "Cached fitness differs from rasterizer"
+    print(cache)
+    assert cache.hits > 0, "Footprint cache was never hit"
+
+
+def fitness_cache_test():
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    raster_fitness = rasterizer.RasterFitnessFunction(target_images)
+    settings = target_images + [genetics.CAMERA_DISTANCE, genetics.FITNESS_FUNCTION_FACTOR]
+    configs = [genetics.Individual.random_individual(220).genom for _ in range(3)]
+    cache = fitness.FitnessCache(directory="tmp/fitness_cache", settings=settings)
+    cached_fitness = cache.cached(raster_fitness.fitness_function)
+    expected = [cached_fitness(config) for config in configs]
+    assert cached_fitness(copy.deepcopy(configs[0])) == expected[0], "Cached fitness differs"
+    assert cache.hits == 1 and cache.misses == 3, "Unexpected cache hits/misses"
+    cache.close()
+    # a new cache with the same settings finds the persisted values
+    cache = fitness.FitnessCache(directory="tmp/fitness_cache", settings=settings)
+    actual = [cache.get(fitness.FitnessCache.genom_key(config)) for config in configs]
+    print(f"Fitness: {expected}, persisted: {actual}, hit rate: {cache.hit_rate():.2f}")
+    assert actual == expected, "Persisted fitness differs"
+    cache.close()
+
+
+def _write_fitness_cache(index, count):
+    cache = fitness.FitnessCache(directory="tmp/shared_fitness_cache", settings=["shared"])
+    for i in range(count):
+        cache.put(fitness.FitnessCache.genom_key([(index, i, 0, 0, 0, 0)]), index + i / count)
+        cache.get(fitness.FitnessCache.genom_key([(1 - index, i, 0, 0, 0, 0)]))
+        time.sleep(0.01)  # like evaluating, longer than sqlite's default timeout (5 s) in total
+    cache.close()
+
+
+def shared_fitness_cache_test():
+    count = 700
+    path = fitness.FitnessCache(directory="tmp/shared_fitness_cache", settings=["shared"]).path
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    context = multiprocessing.get_context("spawn")
+    writers = [context.Process(target=_write_fitness_cache, args=(i, count)) for i in range(2)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    print(f"Exit codes of the writers: {[writer.exitcode for writer in writers]}")
+    assert all(writer.exitcode == 0 for writer in writers), "Writer failed (database locked?)"
+    cache = fitness.FitnessCache(directory="tmp/shared_fitness_cache", settings=["shared"])
+    values = [cache.get(fitness.FitnessCache.genom_key([(index, i, 0, 0, 0, 0)]))
+              for index in range(2) for i in range(count)]
+    cache.close()
+    assert None not in values, "Values of a writer missing"
+
+
+def cascade_test():
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    raster_fitness = rasterizer.RasterFitnessFunction(target_images)
+    cascade = fitness.CascadeEvaluator(raster_fitness, warmup=5)
+    configs = [genetics.Individual.random_individual(220).genom for _ in range(10)]
+    for config in configs[:5]:
+        actual, exact = cascade.evaluate(config, cutoff=1.0)
+        expected = raster_fitness.fitness_function(config)
+        print(f"Fitness: {expected:.6f}, (cascade): {actual:.6f}, margin: {max(cascade.deviations):.6f}")
+        assert exact and abs(expected - actual) < 1e-6, "Cascade fitness differs during warmup"
+    for config in configs[5:]:
+        assert not cascade.evaluate(config, cutoff=1.0)[1], "Cascade did not reject"
+        assert cascade.evaluate(config, cutoff=-1.0)[1], "Cascade rejected"
+    print(cascade)
+    # coarse estimates above the full fitness (negative deviations): a rejected child
+    # must still rank below the cutoff
+    cascade.deviations.clear()
+    cascade.deviations.extend([-0.05] * cascade.warmup)
+    estimate = raster_fitness.coarse_fitness(configs[0])
+    cutoff = estimate - 0.01
+    actual, exact = cascade.evaluate(configs[0], cutoff=cutoff)
+    print(f"Coarse estimate: {estimate:.6f}, cutoff: {cutoff:.6f}, rejected with: {actual:.6f}")
+    assert not exact and actual < cutoff, "Rejected child not below the cutoff"
+    genetics.FITNESS_BACKEND, genetics.CASCADE_EVALUATION = "incremental", True
+    incremental = genetics.Genetics(target_images)
+    incremental.setup_evaluation()
+    assert incremental.cascade is None, "Cascade with an exact coarse stage"
+    assert not incremental.evaluate(configs[0], cutoff=1.0)[1], "Exact fitness flagged as estimate"
+
+
+def early_exit_test():
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    raster_fitness = rasterizer.RasterFitnessFunction(target_images)
+    config = genetics.Individual.random_individual(220).genom
+    expected = raster_fitness.fitness_function(config)
+    actual = raster_fitness.fitness_function(config, threshold=expected)
+    assert not raster_fitness.partial and actual == expected, "Fitness differs with reachable threshold"
+    bound = raster_fitness.fitness_function(config, threshold=0.5)
+    print(f"Fitness: {expected:.6f}, bound: {bound:.6f}, skipped views: {raster_fitness.skipped_views}")
+    assert raster_fitness.partial and expected <= bound < 0.5, "No early exit below threshold"
+    # perfect views score above 1 for masks with ink outside of the target, a threshold
+    # between 1 and the fitness of perfect views must not exit early
+    def render_perfect_view(i):
+        raster_fitness.ink[i] = raster_fitness.target[i]
+    raster_fitness.render_view = render_perfect_view
+    perfect = float(raster_fitness.max_scores.mean())
+    print(f"Highest scores: {np.round(raster_fitness.max_scores, 3)}, fitness of perfect views: {perfect:.6f}")
+    assert perfect > 1.0, "No view scores above 1"
+    actual = raster_fitness.fitness_function(config, threshold=(1.0 + perfect) / 2)
+    assert not raster_fitness.partial and abs(actual - perfect) < 1e-6, "Early exit although the threshold is reachable"
+
+
+def mask_store_test():
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    fitness.MaskStore.compile(target_images, "tmp/masks.bin")
+    store = fitness.MaskStore.load(target_images, "tmp/masks.bin")
+    decoded_fitness = rasterizer.RasterFitnessFunction(target_images)
+    stored_fitness = rasterizer.RasterFitnessFunction(target_images, mask_store=store)
+    for i, image in enumerate(decoded_fitness.mask_images):
+        assert abs(store["darkness"][i] - image.darkness) < 1e-9, "Darkness differs"
+        assert abs(store["inverted_darkness"][i] - decoded_fitness.inverted_mask_images[i].darkness) < 1e-9, \
+            "Inverted darkness differs"
+    config = genetics.Individual.random_individual(220).genom
+    expected = decoded_fitness.fitness_function(config)
+    actual = stored_fitness.fitness_function(config)
+    print(f"Fitness (images): {expected:.6f}, (mask store): {actual:.6f}")
+    assert expected == actual, "Fitness differs with mask store"
+
+
+def debug_mask_store_test(app):
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    store = fitness.MaskStore.load(target_images, "tmp/masks.bin")
+    config = genetics.Individual.random_individual(220).genom
+    fitness.DEBUG = True
+    try:
+        expected = fitness.FitnessFunction(app, target_images).fitness_function(config)
+        actual = fitness.FitnessFunction(app, target_images, mask_store=store).fitness_function(config)
+    finally:
+        fitness.DEBUG = False
+    print(f"Debug fitness (images): {expected:.6f}, (mask store): {actual:.6f}")
+    assert expected == actual, "Debug fitness differs with mask store"
+
+
+def population_test():
+    population = genetics.Population.random(50, 220)
+    children = genetics.Population.breed(population, 40).mutate(genetics.Population.rng.integers(0, 40, 100))
+    for genes in (population.genes, children.genes):
+        assert genes.shape[1:] == (220, 6) and genes.dtype == "int32", "Unexpected population array"
+        assert genes[:, :, 0].min() >= 0 and genes[:, :, 0].max() <= 9, "Digit out of range"
+        assert abs(genes[:, :, 1:4]).max() <= genetics.RADIUS, "Position out of range"
+        assert genes[:, :, 4].min() >= genetics.MIN_SCALE and genes[:, :, 4].max() <= genetics.MAX_SCALE, \
+            "Scale out of range"
+        assert genes[:, :, 5].min() >= 0 and genes[:, :, 5].max() < 360, "Heading out of range"
+    winner = children.individuals()[0].genom
+    restored = genetics.Population.from_json([json.loads(json.dumps(genetics.Population.to_json(winner)))])
+    assert (restored.genes[0] == winner).all(), "JSON round trip differs"
+    print(f"Population: {population.genes.shape}, children: {children.genes.shape}")
+
+
+def copy_on_write_test():
+    parents = [genetics.Individual.random_individual(220) for _ in range(3)]
+    for parent in parents:
+        parent.fitness = 1.0
+    snapshots = [copy.deepcopy(parent.genom) for parent in parents]
+    children = [genetics.Individual.breed(list(parents)) for _ in range(10)]
+    children.append(parents[0].copy())
+    for child in children:
+        child.mutate(50)
+    for parent, snapshot in zip(parents, snapshots):
+        assert [list(gene) for gene in parent.genom] == [list(gene) for gene in snapshot], "Parent changed"
+        assert parent.fitness == 1.0, "Parent fitness reset"
+    shared = sum(gene is other for gene in children[-1].genom for other in parents[0].genom)
+    print(f"Genes shared between copy and parent after 50 mutations: {shared} of {len(parents[0])}")
+    assert shared >= len(parents[0]) - 50, "Unchanged genes not shared with the parent"
+
+
+def checkpoint_test():
+    genetics.CHECKPOINT = "tmp/checkpoint.npz"
+    try:
+        target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+        original = genetics.Genetics(target_images)
+        original.fitness_cache = fitness.FitnessCache()
+        population = original.create_random_population(50)
+        for i, individual in enumerate(population):
+            individual.fitness = i / 10 if i % 5 else None
+        original.fitness_cache.put(fitness.FitnessCache.genom_key(population[0].genom), 0.25)
+        original.generation, original.worst_survivor_fitness, original.stagnation_count = 41, 0.5, 2
+        original.save_checkpoint(population)
+        original.checkpoint_writer.join()
+        expected = (random.random(), genetics.Population.rng.random())
+        restored = genetics.Genetics(target_images)
+        restored.fitness_cache = fitness.FitnessCache()
+        start = time.time()
+        resumed = restored.load_checkpoint()
+        print(f"Resumed in {(time.time() - start) * 1000:.1f}ms from {os.path.getsize(genetics.CHECKPOINT)} bytes")
+        assert [ind.genom for ind in resumed] == [[tuple(gene) for gene in ind.genom] for ind in population]
+        assert [ind.fitness for ind in resumed] == [ind.fitness for ind in population]
+        assert restored.generation == 41 and restored.stagnation_count == 2
+        assert restored.fitness_cache.get(fitness.FitnessCache.genom_key(population[0].genom)) == 0.25
+        assert (random.random(), genetics.Population.rng.random()) == expected, "Random state not restored"
+    finally:
+        genetics.CHECKPOINT = ""
+
+
+def steady_state_test():
+    genetics.FITNESS_BACKEND, genetics.STEADY_STATE = "raster", True
+    genetics.SIZE_OF_GENERATION, genetics.SIZE_OF_GENOM, genetics.TOURNAMENT_SIZE = 20, 50, 5
+    steady_state = genetics.Genetics([f"img/h_{i}.png" for i in range(1, 13)])
+    logged = []
+    log_stats = steady_state.log_stats
+    steady_state.log_stats = lambda population, *args: logged.append(population) or log_stats(population, *args)
+    steady_state.run()
+    assert all(len({id(ind) for ind in population}) == len(population) for population in logged), \
+        "Individuals logged twice"
+    num_survivors = int(genetics.SIZE_OF_GENERATION * genetics.SURVIVOR_RATE)
+    expected = genetics.TOURNAMENT_SIZE * (genetics.SIZE_OF_GENERATION - num_survivors) + genetics.SIZE_OF_GENERATION
+    print(f"Evaluations: {steady_state.evaluations}, winner: {steady_state.winner_fitness:.6f}")
+    assert steady_state.generation == genetics.TOURNAMENT_SIZE, "Steady-state run did not finish"
+    assert num_survivors < steady_state.evaluations <= expected, "Unexpected number of evaluations"
+    genetics.ARRAY_POPULATION = True
+    array_steady_state = genetics.Genetics([f"img/h_{i}.png" for i in range(1, 13)])
+    array_steady_state.run()
+    print(f"Evaluations (array population): {array_steady_state.evaluations}, "
+          f"winner: {array_steady_state.winner_fitness:.6f}")
+    assert array_steady_state.generation == genetics.TOURNAMENT_SIZE, "Steady-state run with array population did not finish"
+    assert np.asarray(array_steady_state.winner).shape == (genetics.SIZE_OF_GENOM, 6), "Unexpected winner genom"
+
+
+def island_test():
+    genetics.FITNESS_BACKEND, genetics.ISLANDS, genetics.MIGRATION_INTERVAL = "raster", 2, 1
+    genetics.SIZE_OF_GENERATION, genetics.SIZE_OF_GENOM, genetics.TOURNAMENT_SIZE = 10, 30, 3
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    queues = [queue.Queue(), queue.Queue()]
+    islands = [genetics.Genetics(target_images) for _ in queues]
+    survivors = []
+    for i, island in enumerate(islands):
+        island.island = (i, queues)
+        island.generation = genetics.MIGRATION_INTERVAL
+        survivors.append([genetics.Individual.random_individual(30) for _ in range(6)])
+        for j, individual in enumerate(survivors[i]):
+            individual.fitness = i + (5 - j) / 10
+    islands[1].migrate(survivors[1])
+    survivors[0] = islands[0].migrate(survivors[0])
+    print(f"Survivors of island 0 after migration: {[individual.fitness for individual in survivors[0]]}")
+    assert len(survivors[0]) == 6 and survivors[0][0].fitness == 1.5, "Immigrants not received"
+    island_run = genetics.Genetics(target_images)
+    island_run.run_islands()
+    print(f"Winner of the islands: {island_run.winner_fitness:.6f}")
+    assert island_run.winner is not None, "No winner of the islands"
+    failing = genetics.Genetics(["img/missing.png"] * 12)
+    start = time.time()
+    try:
+        failing.run_islands()
+        assert False, "Failed island not reported"
+    except RuntimeError as e:
+        print(f"Reported after {time.time() - start:.1f} s: {str(e).splitlines()[0]}")
+
+
+def worker_counters_test():
+    genetics.FITNESS_BACKEND, genetics.WORKERS = "raster", 1
+    genetics.CASCADE_EVALUATION, genetics.EARLY_EXIT = True, True
+    genetics.SIZE_OF_GENERATION, genetics.SIZE_OF_GENOM, genetics.TOURNAMENT_SIZE = 20, 50, 3
+    pool_run = genetics.Genetics([f"img/h_{i}.png" for i in range(1, 13)])
+    pool_run.run()
+    counters = pool_run.counters()
+    print(f"Evaluations: {pool_run.evaluations}, counters of the workers: {dict(counters)}")
+    assert pool_run.cascade is None, "Cascade evaluated in the main process"
+    assert counters["coarse_evaluations"] == pool_run.evaluations, "Cascade counters of the workers missing"
+    assert counters["coarse_evaluations"] == counters["full_evaluations"] + counters["rejected"] + \
+        counters["early_exits"], "Cascade counters do not add up"
+
+
+def surrogate_test():
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    raster_fitness = rasterizer.RasterFitnessFunction(target_images)
+    surrogate = fitness.SurrogateModel(target_images, warmup=50, min_correlation=0.2)
+    random.seed(0)
+    configs = [genetics.Individual.random_individual(220).genom for _ in range(200)]
+    features = surrogate.features(configs)
+    actual = np.array([raster_fitness.fitness_function(config) for config in configs])
+    assert features.shape == (200, 2 * raster_fitness.view_count), "Unexpected feature shape"
+    assert surrogate.predict(features) is None, "Prediction before warmup"
+    surrogate.train(features[:150], actual[:150])
+    surrogate.track(surrogate.predict(features[150:]), actual[150:])
+    print(surrogate)
+    assert surrogate.active, "Surrogate predictions do not correlate with the fitness"
+    surrogate.track(actual[:3], -actual[:3])
+    assert not surrogate.active, "Surrogate not switched off"
+
+
+def surrogate_screening_test():
+    genetics.FITNESS_BACKEND, genetics.SIZE_OF_GENERATION, genetics.SURVIVOR_RATE = "raster", 20, 0.8
+    target_images = [f"img/h_{i}.png" for i in range(1, 13)]
+    screening = genetics.Genetics(target_images)
+    screening.setup_evaluation()
+    screening.surrogate = fitness.SurrogateModel(target_images, warmup=20, min_correlation=-1.0)
+    random.seed(1)
+    configs = [genetics.Individual.random_individual(220).genom for _ in range(30)]
+    features = screening.surrogate.features(configs)
+    actual = np.array([screening.fitness.fitness_function(config) for config in configs])
+    screening.surrogate.train(features, actual)
+    screening.surrogate.track(screening.surrogate.predict(features), actual)
+    assert screening.surrogate.active, "Surrogate not active"
+    population = screening.create_random_population(genetics.SIZE_OF_GENERATION)
+    screening.evaluate_population(population)
+    population.sort(key=lambda x: x.getFitness(), reverse=True)
+    num_survivors = int(genetics.SIZE_OF_GENERATION * genetics.SURVIVOR_RATE)
+    estimated = sum(individual.estimated for individual in population[:num_survivors])
+    print(f"{screening.surrogate}, estimated survivors: {estimated} of {num_survivors}")
+    assert screening.surrogate.screened > 0, "No child screened"
+    assert estimated == 0, "Screened children survive"
+
+
+def local_search_test():
+    genetics.FITNESS_BACKEND, genetics.MEMETIC_BUDGET = "incremental", 30
+    local_search = genetics.Genetics([f"img/h_{i}.png" for i in range(1, 13)])
+    local_search.setup_evaluation()
+    start = genetics.Individual.random_individual(220)
+    start_fitness = local_search.fitness.fitness_function(start.genom)
+    genom, best_fitness, evaluations = local_search.climb(start.genom, start_fitness)
+    print(f"Fitness: {start_fitness:.6f} -> {best_fitness:.6f} in {evaluations} evaluations")
+    assert best_fitness >= start_fitness and evaluations <= genetics.MEMETIC_BUDGET, "Local search got worse"
+    assert abs(local_search.fitness.fitness_function(genom) - best_fitness) < 1e-6, "Fitness of the result differs"
+    assert sum(a != b for a, b in zip(genom, start.genom)) <= evaluations, "More genes changed than evaluated"
+
+
+def telemetry_test():
+    timers = telemetry.StageTimers()
+    with timers("disabled"):
+        pass
+    assert timers.reset() == {}, "Disabled timers recorded a stage"
+    timers.enabled = True
+    for _ in range(3):
+        with timers("sleep"):
+            time.sleep(0.01)
+    stages = timers.reset()
+    assert stages["sleep"]["calls"] == 3 and stages["sleep"]["seconds"] >= 0.03, "Stage not timed"
+    assert timers.reset() == {}, "Timers not reset"
+    def time_stages():
+        for _ in range(20000):
+            with timers("thread"):
+                pass
+    threads = [threading.Thread(target=time_stages) for _ in range(4)]
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert timers.reset()["thread"]["calls"] == 80000, "Stages of threads lost"
+    log = telemetry.TelemetryLog("tmp/telemetry.jsonl")
+    log.write({"generation": 0, "stages": stages, "max_rss_mb": telemetry.max_rss_mb()})
+    log.close()
+    with open("tmp/telemetry.jsonl") as f:
+        record = json.loads(f.readlines()[-1])
+    print(record)
+    assert record["stages"] == stages, "Telemetry record differs"
+
+
+def asset_cache_test():
+    visualization.ASSET_CACHE = "tmp/asset_cache_test/"
+    path = f"{visualization.ASSET_CACHE}digits_{visualization.asset_digest()}.bam"
+    if os.path.exists(path):
+        os.remove(path)
+    start = time.perf_counter()
+    built = visualization.load_digits()
+    build_time = time.perf_counter() - start
+    assert os.path.isfile(path), "Assets not cached"
+    start = time.perf_counter()
+    cached = visualization.load_digits()
+    load_time = time.perf_counter() - start
+    print(f"Build: {build_time * 1000:.1f} ms, load from cache: {load_time * 1000:.1f} ms")
+    for i, (expected, actual) in enumerate(zip(built, cached)):
+        expected_back, actual_back = expected.find(f"digit {i} back"), actual.find(f"digit {i} back")
+        assert expected.getTexture().getRamImage().getData() == actual.getTexture().getRamImage().getData(), \
+            f"Texture of digit {i} differs"
+        assert expected_back.getTexture().getRamImage().getData() == actual_back.getTexture().getRamImage().getData(), \
+            f"Texture of the back of digit {i} differs"
+        assert actual_back.getH() == 180, "Back not turned"
+
+
 if __name__ == "__main__":
     cases = [k[: -5] for k in dir() if k.endswith("_test") and not k.startswith("_")]
     arguments = ", ".join(sorted([k for k in cases])).replace("'", " ")
@@ -2,13 +2,32 @@
 
 import sys
 import json
+import hashlib
+import os
+from collections import Counter
+from math import ceil, sqrt
+import numpy as np
 from panda3d.core import *
 from direct.gui.DirectGui import OnscreenText
 from direct.showbase.ShowBase import ShowBase
 from direct.task import Task
+from telemetry import timers
 
 SIZE_SCALE = 1000.0
 
+# the digit models with their prebaked textures are built once and stored as .bam file
+# in this directory, keyed by a hash of the source images and the plane model
+# (empty: always build them from the sources)
+ASSET_CACHE = "tmp/assets/"
+PLANE_MODEL = "models/plane.egg"
+# part of the key, increase when load_digit() builds the digits differently
+ASSET_VERSION = 1
+
+# one texture stage shared by all digits, so that the texture of a digit's back
+# replaces the texture inherited from its front (instead of being a second stage)
+DIGIT_TEXTURE_STAGE = TextureStage('ts')
+DIGIT_TEXTURE_STAGE.setMode(TextureStage.MReplace)
+
 # Macro-like function used to reduce the amount to code needed to create the
 # on screen instructions
 def genLabelText(text, i):
@@ -18,14 +37,47 @@ def genLabelText(text, i):
 
 # This helpers reduce the amount of code used by loading objects, since all of
 # the objects are pretty much the same.
-def load_digit(i):
-    image = PNMImage(f"img/{i}.png")
-    front = _load_digit(f"digit {i}", image)
+def load_digits(path="img/"):
+    """
+    return the models of the ten digits (see load_digit()), loaded from the asset cache
+    or built from the sources and stored in the cache
+    """
+    cache_path = f"{ASSET_CACHE}digits_{asset_digest(path)}.bam" if ASSET_CACHE else None
+    if cache_path and os.path.isfile(cache_path):
+        root = NodePath(Loader.getGlobalPtr().loadSync(Filename.fromOsSpecific(cache_path)))
+        return [root.find(f"digit {i}") for i in range(10)]
+    plane = NodePath(Loader.getGlobalPtr().loadSync(Filename.fromOsSpecific(PLANE_MODEL)))
+    root = NodePath("digits")
+    digits = [load_digit(i, plane, path) for i in range(10)]
+    for digit in digits:
+        digit.reparentTo(root)
+    if cache_path:
+        os.makedirs(ASSET_CACHE, exist_ok=True)
+        # write to a temporary file first, so that no process loads a partial file
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        root.writeBamFile(Filename.fromOsSpecific(tmp_path))
+        os.replace(tmp_path, cache_path)
+    return digits
+
+
+def asset_digest(path="img/"):
+    """
+    return a hash of the digit images, the plane model and ASSET_VERSION (key of the asset cache)
+    """
+    digest = hashlib.blake2b(str(ASSET_VERSION).encode(), digest_size=16)
+    for source in [f"{path}{i}.png" for i in range(10)] + [PLANE_MODEL]:
+        with open(source, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def load_digit(i, plane, path="img/"):
+    image = PNMImage(f"{path}{i}.png")
+    front = _load_digit(f"digit {i}", image, plane)
     # front.setPos(-1, 0, 0)
-    image = PNMImage(f"img/{i}.png")
+    image = PNMImage(f"{path}{i}.png")
     flip_image_and_exchange_black_with_white(image)
-    image.write(f"tmp/{i}_b.png")
-    back = _load_digit(f"digit {i} back", image)
+    back = _load_digit(f"digit {i} back", image, plane)
     back.reparentTo(front)
     back.setH(180)
     # back.setPos(1, 0, 0)
@@ -39,25 +91,152 @@ def flip_image_and_exchange_black_with_white(image):
     image.threshold(image, 0, 0.9, white, image)
 
 
-def _load_digit(name, image):
-    obj = base.loader.loadModel("models/plane")
+def _load_digit(name, image, plane):
+    obj = plane.copyTo(NodePath())
     obj.name = f"{name}"
     obj.setTransparency(TransparencyAttrib.MAlpha)       
     tex = Texture()
     tex.load(image)
     tex.setWrapU(SamplerState.WM_clamp)
     tex.setWrapV(SamplerState.WM_clamp)
-    ts = TextureStage('ts')
-    ts.setMode(TextureStage.MReplace)
-    obj.setTexture(ts, tex)
+    obj.setTexture(DIGIT_TEXTURE_STAGE, tex)
     return obj
 
 
+class DigitAtlas():
+    """
+    All digits of a configuration as one geom (a single draw call): the textures of the
+    front and the back of the digits are packed into one atlas texture, each gene is two
+    quads whose transformed corners and atlas texture coordinates are written to the
+    vertex data by set_configuration().
+    A geom is sorted as a whole in Panda3D's transparent bin, so sort() orders the quads
+    back to front for a view (like the digit nodes would be sorted).
+    """
+
+    def __init__(self, digits, parent):
+        geom = digits[0].find("+GeomNode").node().getGeom(0)
+        vertices = GeomVertexReader(geom.getVertexData(), "vertex")
+        texcoords = GeomVertexReader(geom.getVertexData(), "texcoord")
+        corners, uvs = [], []
+        while not vertices.isAtEnd():
+            corners.append(tuple(vertices.getData3()))
+            uvs.append(tuple(texcoords.getData2()))
+        triangles = geom.getPrimitive(0).decompose()
+        # the back is the front turned by 180 degrees (see load_digit())
+        front = np.array(corners, dtype=np.float64)
+        self.corners = np.concatenate([front, front * (-1, -1, 1)])
+        self.triangles = np.array([triangles.getVertex(i) for i in range(triangles.getNumVertices())])
+        self.uvs, self.texture = self._make_atlas(digits, np.array(uvs, dtype=np.float32))
+
+        self.format = GeomVertexFormat.getV3t2()
+        self.vertex_data = GeomVertexData("digits", self.format, Geom.UHDynamic)
+        self.primitive = GeomTriangles(Geom.UHDynamic)
+        self.primitive.setIndexType(GeomEnums.NT_uint32)
+        geom = Geom(self.vertex_data)
+        geom.addPrimitive(self.primitive)
+        node = GeomNode("digits")
+        node.addGeom(geom)
+        self.node = parent.attachNewNode(node)
+        # the digit's texture is replaced by the atlas: digits loaded from the asset cache have
+        # their own texture stage, which would add a second stage (see DIGIT_TEXTURE_STAGE)
+        self.node.setState(digits[0].getState().removeAttrib(TextureAttrib.getClassSlot()))
+        self.node.setTexture(DIGIT_TEXTURE_STAGE, self.texture)
+        self.centers = np.zeros((0, 3))
+
+
+    def _make_atlas(self, digits, uvs):
+        """
+        return the texture coordinates of the quads (per digit and side) in the atlas and the
+        atlas, each texture gets a border of one texel copied from its edges (clamping)
+        """
+        textures = []
+        for i, digit in enumerate(digits):
+            textures.append(digit.getTexture())
+            textures.append(digit.find(f"digit {i} back").getTexture())
+        first = textures[0]
+        width, height = first.getXSize(), first.getYSize()
+        components = first.getNumComponents()
+        columns = ceil(sqrt(len(textures)))
+        rows = ceil(len(textures) / columns)
+        # power of two, so that the atlas is never rescaled
+        atlas_width = 1 << ((columns * (width + 2) - 1).bit_length())
+        atlas_height = 1 << ((rows * (height + 2) - 1).bit_length())
+        image = np.zeros((atlas_height, atlas_width, components), dtype=np.uint8)
+        atlas_uvs = np.zeros((len(textures), len(uvs), 2), dtype=np.float32)
+        for i, texture in enumerate(textures):
+            row, column = divmod(i, columns)
+            x, y = column * (width + 2), row * (height + 2)
+            ram = np.frombuffer(texture.getRamImage(), dtype=np.uint8).reshape(height, width, components)
+            image[y:y + height + 2, x:x + width + 2] = np.pad(ram, ((1, 1), (1, 1), (0, 0)), mode="edge")
+            atlas_uvs[i, :, 0] = (x + 1 + uvs[:, 0] * width) / atlas_width
+            atlas_uvs[i, :, 1] = (y + 1 + uvs[:, 1] * height) / atlas_height
+        atlas = Texture("digit atlas")
+        atlas.setup2dTexture(atlas_width, atlas_height, first.getComponentType(), first.getFormat())
+        atlas.setRamImage(image.tobytes())
+        atlas.setWrapU(SamplerState.WM_clamp)
+        atlas.setWrapV(SamplerState.WM_clamp)
+        atlas.setMinfilter(first.getMinfilter())
+        atlas.setMagfilter(first.getMagfilter())
+        return atlas_uvs, atlas
+
+
+    def set_configuration(self, data):
+        """
+        write the quads of the configuration (see Visualizer.get_configuration()) to the vertex data
+        """
+        genes = np.array(data, dtype=np.float64).reshape(-1, 6)
+        self.centers = genes[:, 1:4] / SIZE_SCALE
+        heading = np.radians(genes[:, 5])
+        scale = genes[:, 4] / SIZE_SCALE
+        cos, sin = np.cos(heading)[:, None] * scale[:, None], np.sin(heading)[:, None] * scale[:, None]
+        x, y, z = self.corners[:, 0], self.corners[:, 1], self.corners[:, 2]
+        vertices = np.empty((len(genes), len(self.corners), 5), dtype=np.float32)
+        vertices[:, :, 0] = x * cos - y * sin + self.centers[:, 0:1]
+        vertices[:, :, 1] = x * sin + y * cos + self.centers[:, 1:2]
+        vertices[:, :, 2] = z * scale[:, None] + self.centers[:, 2:3]
+        digits = genes[:, 0].astype(np.int64)
+        # the front and the back of digit d are the textures 2 * d and 2 * d + 1 of the atlas
+        half = len(self.corners) // 2
+        vertices[:, :half, 3:] = self.uvs[digits * 2]
+        vertices[:, half:, 3:] = self.uvs[digits * 2 + 1]
+        self.vertex_data.setNumRows(len(genes) * len(self.corners))
+        if len(genes):
+            memoryview(self.vertex_data.modifyArray(0)).cast("B")[:] = vertices.tobytes()
+
+
+    def sort(self, degrees, camera_distance):
+        """
+        order the quads back to front as seen by the camera with the scene rotated by degrees
+        """
+        angle = np.radians(degrees)
+        # y of the quads' centers in camera space (the camera looks along +y)
+        depth = self.centers[:, 0] * np.sin(angle) + self.centers[:, 1] * np.cos(angle) - camera_distance
+        order = np.argsort(-depth, kind="stable")
+        half = len(self.corners) // 2
+        # a quad's triangles: front (first half of the corners) and back (second half)
+        triangles = np.concatenate([self.triangles, self.triangles + half])
+        indices = (order[:, None] * len(self.corners) + triangles).astype(np.uint32)
+        array = self.primitive.modifyVertices()
+        array.setNumRows(indices.size)
+        if indices.size:
+            memoryview(array).cast("B")[:] = indices.tobytes()
+
+
 class Visualizer(ShowBase):
 
     def __init__(self, callback=None):
         ShowBase.__init__(self)
-        self.digits = [load_digit(i) for i in range(10)]
+        self.digits = load_digits()
+        # render states (texture) of the front and the back of each digit, swapped on pooled digit nodes
+        self.digit_states = [(digit.getState(), digit.find(f"digit {i} back").getState())
+                             for i, digit in enumerate(self.digits)]
+        self.digit_nodes = []
+        self.digit_backs = []
+        self.node_digits = []  # digit shown by each pooled node
+        self.gene_nodes = {}  # gene -> indices of the nodes showing it
+        self.free_nodes = []  # indices of the hidden nodes
+        self.node_updates = 0  # nodes changed by set_configuration() (moved, shown or hidden)
+        self.configurations = 0
         self.disableMouse()
         self.render.setShaderAuto()        
         self.setBackgroundColor(1, 1, 1, 1)
@@ -66,7 +245,11 @@ class Visualizer(ShowBase):
         self.camera.lookAt(0, 0, 0)
         self.setup_lighting()
         self.scene = None
+        self.atlas = None
+        self.tile_cameras = []
+        self.tile_views = None
         if callback:
+            self.setup_screenshot_texture()
             self.config = []
             self.hourText = None
             callback(self)
@@ -99,22 +282,131 @@ class Visualizer(ShowBase):
         self.render.setLight(self.render.attachNewNode(ambientLight))
 
 
+    def setup_screenshot_texture(self):
+        """
+        Attach a persistent texture to the window (an offscreen buffer in headless
+        mode), the framebuffer is copied into its RAM image after each rendered
+        frame, so screenshots need neither a new texture nor an extra copy.
+        """
+        self.screenshot_texture = Texture("screenshot")
+        self.win.addRenderTexture(self.screenshot_texture, GraphicsOutput.RTMCopyRam)
+
+
+    def setup_tiled_views(self, positions, tile_size):
+        """
+        Prepare rendering of all views in one frame: an offscreen buffer is split
+        into a grid of tiles (columns x rows) with one camera per view.
+        Instead of rotating the scene by the given degrees, each camera is rotated
+        by the opposite angle around the center of the scene.
+        The buffer is created once and reused for the same views, else it is replaced.
+        """
+        if self.tile_views == (tuple(positions), tuple(tile_size)):
+            return
+        if self.tile_views is not None:
+            self.graphicsEngine.removeWindow(self.tile_buffer)
+            self.tile_cameras[0].getParent().getParent().removeNode()
+            self.tile_cameras = []
+        self.tile_views = (tuple(positions), tuple(tile_size))
+        count = len(positions)
+        columns = ceil(sqrt(count))
+        rows = ceil(count / columns)
+        width, height = tile_size
+        self.tile_layout = (rows, columns)
+        self.tile_texture = Texture("tiles")
+        self.tile_buffer = self.win.makeTextureBuffer("tiles", columns * width, rows * height,
+                                                      self.tile_texture, to_ram=True)
+        self.tile_buffer.setClearColor(self.getBackgroundColor())
+        self.tile_buffer.setActive(False)
+        tiles = self.render.attachNewNode("tiles")
+        for i, degrees in enumerate(positions):
+            # tile i is in row i // columns (counted from the bottom) and column i % columns
+            row, column = divmod(i, columns)
+            region = self.tile_buffer.makeDisplayRegion(
+                column / columns, (column + 1) / columns, row / rows, (row + 1) / rows)
+            camera = Camera(f"view {i}")
+            camera.setLens(self.camLens)
+            pivot = tiles.attachNewNode(f"view {i}")
+            pivot.setH(-degrees)
+            camera = pivot.attachNewNode(camera)
+            camera.setPos(0, self.camera_distance, 0)
+            region.setCamera(camera)
+            self.tile_cameras.append(camera)
+
+
     def set_configuration(self, data):
         """
         Set the configuration, for expected format see get_configuration().
+        The digit nodes are pooled and only the difference to the previous configuration
+        is applied: nodes of genes still present are kept, nodes of removed genes are
+        moved to the added genes (swapping the render state if it is another digit),
+        left over nodes are hidden.
         """
-        if (self.scene):
-            self.scene.detachNode()
-        self.config = []
-        self.scene = self.render.attachNewNode("scene")
-        self.scene.reparentTo(self.render)
-        for item in data:
-            digit = self.digits[item[0]].copyTo(self.scene)
-            digit.reparentTo(self.scene)
-            digit.setPos(item[1]/SIZE_SCALE, item[2]/SIZE_SCALE, item[3]/SIZE_SCALE)
-            digit.setScale(item[4]/SIZE_SCALE)
-            digit.setH(item[5])
-            self.config.append(digit)
+        with timers("set_configuration"):
+            if self.scene is None:
+                self.scene = self.render.attachNewNode("scene")
+            if self.atlas is not None:
+                self.atlas.set_configuration(data)
+                self.node_updates += len(data)
+                self.configurations += 1
+                return
+            counts = Counter(tuple(item) for item in data)
+            removed = []
+            for gene, nodes in list(self.gene_nodes.items()):
+                surplus = len(nodes) - counts.get(gene, 0)
+                if surplus > 0:
+                    removed += nodes[-surplus:]
+                    del nodes[-surplus:]
+                    if not nodes:
+                        del self.gene_nodes[gene]
+            for gene, count in counts.items():
+                nodes = self.gene_nodes.setdefault(gene, [])
+                for _ in range(count - len(nodes)):
+                    if removed:
+                        i = removed.pop()
+                    elif self.free_nodes:
+                        i = self.free_nodes.pop()
+                        self.digit_nodes[i].show()
+                    else:
+                        i = self._add_digit_node()
+                    self._update_digit_node(i, gene)
+                    nodes.append(i)
+            for i in removed:
+                self.digit_nodes[i].hide()
+            self.free_nodes += removed
+            self.node_updates += len(removed)
+            self.configurations += 1
+            self.config = [self.digit_nodes[i] for nodes in self.gene_nodes.values() for i in nodes]
+
+
+    def setup_atlas(self):
+        """
+        Render the digits as one geom with a texture atlas (see DigitAtlas) instead of
+        two nodes per digit, views are rendered one at a time (no tiled views).
+        """
+        if self.scene is None:
+            self.scene = self.render.attachNewNode("scene")
+        self.set_configuration([])
+        self.atlas = DigitAtlas(self.digits, self.scene)
+
+
+    def _add_digit_node(self):
+        self.digit_nodes.append(self.digits[0].copyTo(self.scene))
+        self.digit_backs.append(self.digit_nodes[-1].find("digit 0 back"))
+        self.node_digits.append(0)
+        return len(self.digit_nodes) - 1
+
+
+    def _update_digit_node(self, i, item):
+        digit = self.digit_nodes[i]
+        if self.node_digits[i] != item[0]:
+            front_state, back_state = self.digit_states[item[0]]
+            digit.setState(front_state)
+            self.digit_backs[i].setState(back_state)
+            self.node_digits[i] = item[0]
+        scale = item[4]/SIZE_SCALE
+        digit.setPosHprScale(item[1]/SIZE_SCALE, item[2]/SIZE_SCALE, item[3]/SIZE_SCALE,
+                             item[5], 0, 0, scale, scale, scale)
+        self.node_updates += 1
 
 
     def rotate_scene(self, task):
@@ -155,10 +447,32 @@ class Visualizer(ShowBase):
 
 
     def make_screenshot(self, degrees):
+        """
+        Render the scene rotated by the given degrees and return the screenshot
+        texture, note that the same texture is reused for every screenshot.
+        """
         self.rotate_to(degrees=degrees)
-        base.graphicsEngine.renderFrame()
-        shot = self.win.getScreenshot()
-        return shot
+        if self.atlas is not None:
+            self.atlas.sort(degrees, self.camera_distance)
+        with timers("render_frame"):
+            base.graphicsEngine.renderFrame()
+        return self.screenshot_texture
+
+
+    def make_tiled_screenshot(self):
+        """
+        Render all views prepared by setup_tiled_views() in one frame and return the
+        tiled texture, note that the same texture is reused for every screenshot.
+        """
+        if self.scene:
+            self.scene.setH(0)
+        self.camNode.setActive(False)
+        self.tile_buffer.setActive(True)
+        with timers("render_frame"):
+            base.graphicsEngine.renderFrame()
+        self.tile_buffer.setActive(False)
+        self.camNode.setActive(True)
+        return self.tile_texture
 
 
     def toggle_rotation(self, rotating=None):
@@ -178,6 +492,8 @@ class Visualizer(ShowBase):
     def set_camera_distance(self, distance):
         self.camera_distance = distance
         self.camera.setPos(0, self.camera_distance, 0)
+        for camera in self.tile_cameras:
+            camera.setPos(0, self.camera_distance, 0)
 
 
 def headless_app(callback, prc_file="headless.prc"):